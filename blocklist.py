@@ -0,0 +1,144 @@
+# matching IP addresses against blocklist entries, which can be single addresses or CIDR ranges of either version
+
+from bisect import bisect_right
+
+BITS = {4: 32, 6: 128}
+
+
+def parseIPv4(text):
+    parts = text.split(".")
+    if len(parts) != 4:
+        return None
+    number = 0
+    for part in parts:
+        if not part.isdigit() or len(part) > 3 or int(part) > 255:
+            return None
+        number = (number << 8) | int(part)
+    return number
+
+
+def parseIPv6(text):
+    if "::" in text:
+        head, sep, tail = text.partition("::")
+        if "::" in tail:
+            return None
+        head = head and head.split(":") or []
+        tail = tail and tail.split(":") or []
+    else:
+        head, tail = text.split(":"), None
+
+    def numbers(parts):
+        result = []
+        for i, part in enumerate(parts):
+            if "." in part and i == len(parts) - 1:
+                # a trailing IPv4 address fills the last two groups
+                ipv4 = parseIPv4(part)
+                if ipv4 is None:
+                    return None
+                result.extend([ipv4 >> 16, ipv4 & 0xffff])
+            elif 0 < len(part) <= 4 and all(c in "0123456789abcdefABCDEF" for c in part):
+                result.append(int(part, 16))
+            else:
+                return None
+        return result
+
+    head = numbers(head)
+    if head is None:
+        return None
+    if tail is None:
+        groups = head
+    else:
+        tail = numbers(tail)
+        if tail is None or len(head) + len(tail) > 7:
+            return None
+        groups = head + [0] * (8 - len(head) - len(tail)) + tail
+
+    if len(groups) != 8:
+        return None
+    number = 0
+    for group in groups:
+        number = (number << 16) | group
+    return number
+
+
+def parseAddress(text):
+    """ returns the version and integer value of an address, or None if it isn't one """
+    text = (text or "").strip()
+    if ":" in text:
+        number = parseIPv6(text)
+        if number is None:
+            return None
+        if number >> 32 == 0xffff:
+            # IPv4 addresses seen through IPv6 look like ::ffff:1.2.3.4, so match them against IPv4 entries
+            return 4, number & 0xffffffff
+        return 6, number
+    number = parseIPv4(text)
+    if number is None:
+        return None
+    return 4, number
+
+
+def parseEntry(text):
+    """ returns the version and first and last addresses covered by an entry, or None if it isn't valid """
+    address, sep, prefix = text.strip().partition("/")
+    parsed = parseAddress(address)
+    if not parsed:
+        return None
+    version, number = parsed
+    bits = BITS[version]
+    if sep:
+        if not prefix.isdigit():
+            return None
+        prefix = int(prefix)
+        if ":" in address and version == 4:
+            # a prefix on a mapped address counts the IPv6 bits
+            prefix -= 96
+        if not 0 <= prefix <= bits:
+            return None
+    else:
+        prefix = bits
+    host_mask = (1 << (bits - prefix)) - 1
+    first = number & ~host_mask
+    return version, first, first | host_mask
+
+
+def splitEntries(text):
+    """ splits what was entered into the blocklist field into its entries """
+    return [entry for entry in text.replace(",", " ").split() if entry]
+
+
+class Blocklist(object):
+    """ non-overlapping ranges of blocked addresses for each version, sorted so an address can be found by bisecting """
+
+    def __init__(self, entries):
+        ranges = {4: [], 6: []}
+        for entry in entries:
+            parsed = parseEntry(entry)
+            if parsed:
+                version, first, last = parsed
+                ranges[version].append((first, last))
+
+        self.starts = {}
+        self.ends = {}
+        for version, version_ranges in ranges.items():
+            starts, ends = [], []
+            for first, last in sorted(version_ranges):
+                if ends and first <= ends[-1] + 1:
+                    # merge anything overlapping or touching the previous range
+                    ends[-1] = max(ends[-1], last)
+                else:
+                    starts.append(first)
+                    ends.append(last)
+            self.starts[version] = starts
+            self.ends[version] = ends
+
+    def __len__(self):
+        return sum(len(starts) for starts in self.starts.values())
+
+    def __contains__(self, address):
+        parsed = parseAddress(address)
+        if not parsed:
+            return False
+        version, number = parsed
+        i = bisect_right(self.starts[version], number) - 1
+        return i >= 0 and number <= self.ends[version][i]
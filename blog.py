@@ -9,7 +9,8 @@ PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if PARENT_DIR not in sys.path:
     sys.path.append(PARENT_DIR)
 
-from gae_blog.controllers import admin, author, contact, error, feed, index, pingback, post, tag, trackback, verify, webmention
+from gae_blog import stats
+from gae_blog.controllers import admin, author, contact, error, feed, index, pingback, post, search, tag, trackback, verify, webmention
 
 # url routes
 BLOG_URLS = ['/blog']
@@ -20,6 +21,7 @@ for url in BLOG_URLS:
     ROUTES.extend([(url, index.IndexController),
                    (url + '/feed', feed.FeedController),
                    (url + '/contact', contact.ContactController),
+                   (url + '/search', search.SearchController),
                    (url + '/post/(.[^/]+)', post.PostController),
                    (url + '/tag/(.[^/]+)', tag.TagController),
                    (url + '/author/(.[^/]+)', author.AuthorController),
@@ -38,6 +40,7 @@ for url in BLOG_URLS:
                    (url + '/admin/image', admin.ImageController),
                    (url + '/admin/images', admin.ImagesController),
                    (url + '/admin/migrate', admin.MigrateController),
+                   (url + '/admin/stats', admin.StatsController),
                    (url + '/(.*)', error.ErrorController)
                 ])
 
@@ -56,4 +59,5 @@ config['webapp2_extras.sessions'] = {
     }
 }
 
-app = webapp2.WSGIApplication(ROUTES, config=config, debug=False)
+# times every request for the admin stats page
+app = stats.StatsMiddleware(webapp2.WSGIApplication(ROUTES, config=config, debug=False))
@@ -0,0 +1,190 @@
+# caching that lives in each instance's memory, and the stamps in memcache used to know when anything cached is out of date
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import sha1
+from uuid import uuid4
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from gae_blog.config import BLOG_CACHE_SIZE, BLOG_CACHE_TTL
+from gae_blog import model
+
+
+class LRUCache(object):
+    """ a bounded mapping that forgets the least recently used entries first, safe to share between threads """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            # move it to the most recently used end
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+BLOG_VERSION_KEY = "GAE_BLOG_VERSION"
+
+# slug => (blog, version, time last checked)
+blogs = LRUCache(BLOG_CACHE_SIZE)
+
+
+@ndb.tasklet
+def getBlogVersionAsync(slug):
+    """ the stamp that changes whenever a blog is saved, which is None if memcache can't be reached """
+    context = ndb.get_context()
+    key = BLOG_VERSION_KEY + "|" + slug
+    version = yield context.memcache_get(key)
+    if version is None:
+        # the stamp was evicted, so nothing cached before now can be trusted
+        version = uuid4().hex
+        added = yield context.memcache_add(key, version)
+        if not added:
+            version = yield context.memcache_get(key)
+    raise ndb.Return(version)
+
+
+@ndb.tasklet
+def getBlogAsync(slug):
+    """ looks up a blog, using the copy in memory if it was checked recently or its version hasn't changed
+        the result is shared between requests, so it must not be modified """
+    now = time.time()
+    entry = blogs.get(slug)
+    if entry:
+        blog, version, checked = entry
+        if now - checked < BLOG_CACHE_TTL:
+            raise ndb.Return(blog)
+
+        current = yield getBlogVersionAsync(slug)
+        if current is not None and current == version:
+            blogs.set(slug, (blog, version, now))
+            raise ndb.Return(blog)
+
+    # the version must be read before the blog so that a save in between is caught by the next check
+    version = yield getBlogVersionAsync(slug)
+    blog = yield model.Blog.get_by_id_async(slug)
+    if blog:
+        blogs.set(slug, (blog, version, now))
+    else:
+        blogs.delete(slug)
+    raise ndb.Return(blog)
+
+
+def bumpBlogVersion(slug):
+    """ call after saving a blog so that every instance reloads it """
+    memcache.set(BLOG_VERSION_KEY + "|" + slug, uuid4().hex)
+    blogs.delete(slug)
+
+
+def refreshBlog(slug, version):
+    """ forgets the copy of a blog kept in memory if it isn't the current version, returning whether it did
+        a copy can be used for BLOG_CACHE_TTL without being checked, which is too long for a page that's cached """
+    entry = blogs.get(slug)
+    if entry and version and entry[1] != version:
+        blogs.delete(slug)
+        return True
+    return False
+
+
+GENERATION_KEY = "GAE_BLOG_GENERATION"
+DEPENDENCIES_KEY = "GAE_BLOG_DEPENDENCIES"
+
+# the generations that cached pages depend on, each one changes whenever anything it covers is saved
+BLOG = "blog" # everything that's shown on every page, like the blog's settings and its authors' names
+POSTS = "posts" # the list of published posts
+VERSION = "version" # not a generation, but the blog's version is kept with them so pages change along with it
+# these are followed by the slug of what they cover
+AUTHOR = "author:"
+TAG = "tag:"
+POST = "post:"
+
+
+def generationKey(slug, name):
+    return "|".join([GENERATION_KEY, slug, name])
+
+
+def newGeneration():
+    # starts with when it was made, so that pages can say when they were last modified
+    return str(int(time.time())) + "-" + uuid4().hex
+
+
+def pageETag(page_key, generations):
+    """ changes whenever the page or anything it depends on does """
+    return sha1(page_key + "|" + "|".join([name + "=" + stamp for name, stamp in sorted(generations.items())])).hexdigest()
+
+
+def lastModified(generations):
+    """ when the newest generation a page depends on was made, or None if that isn't known """
+    times = [int(stamp.split("-", 1)[0]) for stamp in generations.values() if stamp and "-" in stamp]
+    return times and datetime.utcfromtimestamp(max(times)) or None
+
+
+def postGenerations(post):
+    """ the generations for every page that shows this post, call before and after changing it to cover both """
+    names = [POST + post.slug]
+    if post.live:
+        names.extend([POSTS, AUTHOR + post.author.string_id()])
+        names.extend([TAG + tag_key.string_id() for tag_key in post.tag_keys])
+    return names
+
+
+def bumpGenerations(slug, names):
+    """ call after saving anything shown on cached pages so that only the pages which depend on it are thrown away """
+    memcache.set_multi(dict([(generationKey(slug, name), newGeneration()) for name in set(names)]))
+
+
+def checkPage(slug, page_key, names):
+    """ compares the generations a page was cached with against the current ones in a single lookup
+        returns whether the cached page can still be used along with the current generations """
+    keys = dict([(generationKey(slug, name), name) for name in names])
+    dependencies_key = DEPENDENCIES_KEY + "|" + page_key
+    version_key = BLOG_VERSION_KEY + "|" + slug
+    stamps = memcache.get_multi(keys.keys() + [dependencies_key, version_key])
+    cached = stamps.pop(dependencies_key, None)
+    version = stamps.pop(version_key, None)
+
+    missing = dict([(key, newGeneration()) for key in keys if key not in stamps])
+    if missing:
+        # a generation that was evicted might have changed, so a new one is started instead of trusting anything
+        failed = memcache.add_multi(missing)
+        stamps.update(missing)
+        if failed:
+            # another request started some of them first
+            stamps.update(memcache.get_multi(failed))
+
+    generations = dict([(keys[key], stamp) for key, stamp in stamps.items()])
+    if version:
+        generations[VERSION] = version
+    return cached == generations, generations
+
+
+def savePage(page_key, generations):
+    """ records the generations a page was rendered with, for checkPage to compare against """
+    memcache.set(DEPENDENCIES_KEY + "|" + page_key, generations)
@@ -0,0 +1,18 @@
+# compiles the templates to python modules, run this before deploying so that instances don't have to compile them
+# usage: python compile_templates.py
+
+import os
+import sys
+
+PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PARENT_DIR not in sys.path:
+    sys.path.append(PARENT_DIR)
+
+from gae_blog.config import COMPILED_TEMPLATES_PATH
+from gae_blog.templating import makeEnvironment
+
+
+if __name__ == "__main__":
+    environment = makeEnvironment(development=True)
+    environment.compile_templates(COMPILED_TEMPLATES_PATH, zip=None, ignore_errors=False)
+    print "compiled " + str(len(environment.list_templates())) + " templates to " + COMPILED_TEMPLATES_PATH
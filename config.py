@@ -8,3 +8,59 @@ BLOG_PATH = os.path.dirname(os.path.abspath(__file__))
 TEMPLATES_DIR = 'templates'
 TEMPLATES_PATH = os.path.join(BLOG_PATH, TEMPLATES_DIR)
 
+# templates compiled to python modules before deploying, see compile_templates.py
+COMPILED_TEMPLATES_PATH = os.path.join(BLOG_PATH, 'templates_compiled')
+
+# the development server re-reads templates as they're edited, but production never checks them for changes
+DEVELOPMENT = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+
+# in-process caching
+BLOG_CACHE_SIZE = 100 # number of blogs kept in memory on each instance
+BLOG_CACHE_TTL = 10 # seconds before a blog kept in memory is checked against its version in memcache
+
+
+# search
+SEARCH_SHARDS = 8 # number of entities each term's postings are split across, by post
+SEARCH_MAX_TERMS = 8 # any more terms in a query are ignored, which bounds the reads per search
+SEARCH_QUEUE = "search" # must only run one task at a time so that updates to the index don't overwrite each other
+
+
+# moderation alert digests
+DIGEST_QUEUE = "digest" # a pull queue holding the alerts until they're sent
+DIGEST_LEASE = 60 # seconds to hold the alerts for while the digest is sent
+DIGEST_BATCH = 1000 # alerts leased at once, which is the most the task queue allows
+
+
+# linkback verification
+VERIFY_QUEUE = "linkbacks" # limits how many sources are fetched at once
+VERIFY_TIMEOUT = 10 # seconds to wait for a source
+VERIFY_MAX_BYTES = 256 * 1024 # the most of a source that's asked for and parsed looking for the link
+
+
+# rate limiting of public writes, with the budgets set on each blog
+THROTTLE_PERIOD = 3600 # seconds for a budget to be used up or refilled in
+THROTTLE_RETRIES = 3 # attempts at updating a bucket when other requests are updating it at the same time
+
+
+# renaming a blog, which copies everything in it to the new slug
+RENAME_BATCH = 100 # entities copied or deleted by each task, which all go in one transaction
+
+
+# migrations that bring data saved by older versions up to date
+MIGRATION_BATCH = 100 # entities changed by each task, which all go in one transaction
+
+
+# request timings shown at /admin/stats
+STATS_ENABLED = True
+STATS_SAMPLES = 100 # most recent requests kept in memcache for each controller
+
+
+# the page cache used when gae_html isn't installed
+BLOG_APP = "gae_blog.blog.app" # the app tasks render pages with, change it if you copy blog.py into your project
+PAGE_CACHE_SIZE = 200 # pages kept in memory on each instance, before memcache and optionally the datastore
+PAGE_CACHE_TTL = 3600 # seconds a page is served for before it's rendered again, even if nothing on it has changed
+PAGE_CACHE_BETA = 1.0 # how eagerly pages are rendered again before that, scaled by how long they took to render
+PAGE_LEASE_TIME = 10 # seconds one request has to render a page before another one is allowed to try
+PAGE_LEASE_WAIT = 2 # seconds to wait for another request rendering a page when there's no older copy to serve
+PAGE_REVALIDATE = True # render out of date pages in a task while the last copy is served, instead of during a request
@@ -1,14 +1,17 @@
 from datetime import datetime
 
-from google.appengine.api import users, memcache, images
-from google.appengine.ext import blobstore, ndb
+from google.appengine.api import datastore_errors, users, images
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import blobstore, deferred, ndb
 from google.appengine.ext.webapp import blobstore_handlers
 
+import webapp2
+
 from base import FormController
 
 from gae_blog.lib.gae_validators import (validateString, validateRequiredString, validateText, validateEmail,
     validateUrl, validateInt, validateBool, validateDateTime)
-from gae_blog import model
+from gae_blog import blocklist, cache, migrations, model, pagecache, stats, throttle
 
 
 def validateDT(source):
@@ -17,6 +20,13 @@ def validateDT(source):
     else:
         return validateDateTime(source, date_format="%Y-%m-%d %H:%M:%S", future_only=False)
 
+def validateBudget(source):
+    # 0 turns a write budget off, but one below that would refuse every write
+    valid, value = validateInt(source)
+    if valid and value is not None and value < 0:
+        return False, value
+    return valid, value
+
 
 class AdminController(FormController):
     """ shows the index page for the admin section, and handles sitewide configuration """
@@ -28,17 +38,33 @@ class AdminController(FormController):
         else:
             super(AdminController, self).dispatch()
 
+    @webapp2.cached_property
+    def blog_future(self):
+        # admin pages modify the blog, so they can't use the copy shared between requests
+        return model.Blog.get_by_id_async(self.blog_slug)
+
     def get(self):
 
         blog = self.blog
+        rename = self.rename
 
         if blog:
             other_blogs = [b for b in model.Blog.query() if b.slug != blog.slug]
-            self.renderTemplate('admin/index.html', blog=blog, other_blogs=other_blogs, page_title="Admin", logout_url=self.logout_url)
+            throttled = throttle.firedCounts(blog.slug)
+            self.renderTemplate('admin/index.html', blog=blog, other_blogs=other_blogs, throttled=throttled,
+                rename=rename, page_title="Admin", logout_url=self.logout_url)
+
+        elif rename:
+            # the blog has moved
+            self.redirect('/' + rename.new_slug + '/admin')
 
         else:
             self.redirect(self.blog_url + '/admin/blog')
 
+    @webapp2.cached_property
+    def rename(self):
+        return model.BlogRename.get_by_id(self.blog_slug)
+
     @property
     def logout_url(self):
         url = None
@@ -54,13 +80,15 @@ class BlogController(AdminController):
         "template": validateString, "posts_per_page": validateInt, "image_preview_size": validateInt,
         "mail_queue": validateRequiredString, "blocklist": validateText, "enable_comments": validateBool,
         "enable_linkbacks": validateBool, "author_pages": validateBool, "admin_email": validateEmail,
-        "moderation_alert": validateBool, "contact": validateBool}
+        "moderation_alert": validateBool, "digest_interval": validateInt, "contact": validateBool,
+        "summaries": validateBool, "ip_write_budget": validateBudget, "blog_write_budget": validateBudget}
 
     def get(self):
 
         form_data, errors = self.errorsFromSession()
 
-        self.renderTemplate('admin/blog.html', form_data=form_data, errors=errors, page_title="Admin - Blog", logout_url=self.logout_url)
+        self.renderTemplate('admin/blog.html', form_data=form_data, errors=errors, rename=self.rename, page_title="Admin - Blog",
+            logout_url=self.logout_url)
 
     def post(self):
 
@@ -70,44 +98,59 @@ class BlogController(AdminController):
 
         if "url" not in errors:
             if not blog or valid_data["url"] != blog.slug:
-                # check to make sure that there isn't already another blog at this URL
-                existing = model.Blog.get_by_id(valid_data["url"])
+                # check to make sure that there isn't already another blog at this URL, or one on its way there
+                existing = model.Blog.get_by_id(valid_data["url"]) or model.renamingTo(valid_data["url"])
                 if existing:
                     errors["url_exists"] = True
+                elif blog and self.rename and not self.rename.finished:
+                    errors["renaming"] = True
+
+        if "blocklist" not in errors:
+            # entries can be separated by lines, spaces or commas
+            valid_data["blocklist"] = blocklist.splitEntries(valid_data["blocklist"] or "")
+            if not all(blocklist.parseEntry(entry) for entry in valid_data["blocklist"]):
+                errors["blocklist"] = True
 
         if errors:
             return self.redisplay(form_data, errors, self.blog_url + '/admin/blog')
 
-        if valid_data["blocklist"]:
-            blocklist = valid_data["blocklist"].split("\r\n")
-            valid_data["blocklist"] = [ip for ip in blocklist if ip] # remove empty lines
-        else:
-            valid_data["blocklist"] = []
-
         url = valid_data["url"]
         del valid_data["url"]
 
         if blog:
-            # if the URL is different, remake the entities since the key name needs to change
-            if url != blog.slug:
-                # each blog is its own entity group, so can't run in a transaction
-                blog = model.makeNew(blog, id=url, use_transaction=False)
             blog.populate(**valid_data)
             existed = True
         else:
             blog = model.Blog(id=url, **valid_data)
             existed = False
 
+        # the copy being changed could be from before a post was scheduled, so this is worked out again
+        blog.next_publish = model.findNextPublish(blog.key)
         blog.put()
+        cache.bumpBlogVersion(blog.slug)
         
         clearCache(blog)
 
+        if url != blog.slug:
+            # the key name needs to change, so everything is copied over to the new one by tasks a batch at a time
+            model.startRename(blog, url, BlogController.renameBlog)
+
         if existed:
             self.redirect('/' + blog.slug + '/admin')
         else:
             self.redirect('/' + blog.slug + '/admin/author/')
 
 
+    @classmethod
+    def renameBlog(cls, old_slug, step):
+        rename = model.renameStep(old_slug, step, cls.renameBlog)
+        if rename and (rename.finished or rename.state == model.DELETING and not rename.deleted):
+            # the new blog has just taken over, or the old one is completely gone
+            for slug in [old_slug, rename.new_slug]:
+                cache.bumpBlogVersion(slug)
+                cache.bumpGenerations(slug, [cache.BLOG])
+
+
 class AuthorsController(AdminController):
     """ handles viewing all authors for this blog """
     def get(self):
@@ -169,6 +212,8 @@ class AuthorController(AdminController):
                             ref_object.author = author.key
                             new_objects.append(ref_object)
                         model.ndb.put_multi(new_objects)
+                    # and keep the posts' cards in step with them
+                    model.ndb.put_multi([post.card for post in posts])
                     return author
                 author = model.ndb.transaction(lambda: author_transaction(author, slug, blog, [posts, comments]))
             author.populate(**valid_data)
@@ -176,8 +221,9 @@ class AuthorController(AdminController):
             author = model.BlogAuthor(id=slug, parent=blog.key, **valid_data)
 
         author.put()
-        
-        memcache.delete_multi(getCacheKeys(blog))
+
+        # author names are shown on every page
+        clearCache(blog)
 
         if blog.authors.count() > 1:
             self.redirect(self.blog_url + '/admin/authors')
@@ -204,14 +250,18 @@ class PostsController(AdminController):
                 except:
                     pass
 
-            blog_posts = blog.posts.order(-model.BlogPost.timestamp)
+            # this only lists the posts, so their cards have everything that's needed
+            blog_posts = blog.cards.order(-model.BlogPostCard.timestamp)
+            if not blog_posts.get(keys_only=True):
+                # blogs saved by older versions don't have cards until the migrations are run
+                blog_posts = blog.posts.order(-model.BlogPost.timestamp)
             posts_per_page = blog.posts_per_page
 
             last_page = (blog_posts.count() - 1) / posts_per_page
             if last_page < 0:
                 last_page = 0
 
-            posts = blog_posts.fetch(posts_per_page, offset=page * posts_per_page)
+            posts = model.prefetchPosts(blog_posts.fetch(posts_per_page, offset=page * posts_per_page))
 
         self.renderTemplate('admin/posts.html', page=page, last_page=last_page, posts=posts,
                             page_title="Admin - Posts", logout_url=self.logout_url)
@@ -223,12 +273,9 @@ class PostsController(AdminController):
             # this is a request to delete this post
             post = model.BlogPost.get_by_id(post_slug, parent=self.blog.key)
             if post:
-                # delete all the post's comments first
-                if post.comments.count() > 0:
-                    model.ndb.delete_multi(post.comments.fetch(keys_only=True))
-                # then the post itself
-                post.key.delete()
-                clearCache(self.blog)
+                # deletes the post's comments along with it
+                model.deletePost(post)
+                cache.bumpGenerations(self.blog.slug, cache.postGenerations(post))
             else:
                 return self.renderError(404)
 
@@ -324,9 +371,10 @@ class PostController(AdminController):
         del valid_data["tags"]
         del valid_data["timestamp_choice"]
 
-        was_published = False
+        # pages that showed the post before it changed have to be thrown away along with ones that show it after
+        generations = []
         if post:
-            was_published = post.published
+            generations = cache.postGenerations(post)
 
             # if the slug is different, remake the entities since the key name needs to change
             if slug != post.slug:
@@ -335,37 +383,43 @@ class PostController(AdminController):
         else:
             post = model.BlogPost(id=slug, parent=blog.key, **valid_data)
 
-        post.put()
+        post.updateSummary()
+        model.putPost(post)
+
+        generations.extend(cache.postGenerations(post))
+        cache.bumpGenerations(blog.slug, generations)
 
         # send them back to the admin list of posts if it's not published or to the actual post if it is
         if post.published:
-            cache_keys = getCacheKeys(blog)
-            memcache.delete_multi(cache_keys)
-            datastore_keys = getDatastoreKeys(blog)
             if post.timestamp > now:
-                # post is in the future, so set the expires on these to just after it's available
-                html_caches = ndb.get_multi(datastore_keys, use_memcache=False)
-                new_html_caches = []
-                diff = int((post.timestamp - now).total_seconds())
-                for html_cache in html_caches:
-                    if html_cache:
-                        html_cache.expires = diff
-                        new_html_caches.append(html_cache)
-                if new_html_caches:
-                    ndb.put_multi(new_html_caches)
-            else:
-                # post is published in the past so just delete everything
-                ndb.delete_multi(datastore_keys)
+                # post is in the future, so the pages it goes on are thrown away and rendered again once it's live
+                deferred.defer(PostController.publishPost, blog.slug, post.slug, post.timestamp,
+                    self.request.host_url, self.request.host, _eta=post.timestamp)
             self.redirect(self.blog_url + '/post/' + post.slug)
         else:
-            if was_published:
-                clearCache(blog)
-
             if self.request.get("preview"):
                 self.redirect(self.blog_url + '/admin/preview/' + post.slug)
             else:
                 self.redirect(self.blog_url + '/admin/posts')
 
+    @classmethod
+    def publishPost(cls, blog_slug, post_slug, timestamp, host_url, host):
+        post = model.BlogPost.get_by_id(post_slug, parent=ndb.Key(model.Blog, blog_slug))
+        # it might have been deleted, unpublished or rescheduled since
+        if not post or not post.published or post.timestamp != timestamp:
+            return
+        if not post.live:
+            # tasks can run a little early, so try again once it's really live
+            deferred.defer(cls.publishPost, blog_slug, post_slug, timestamp, host_url, host, _eta=timestamp)
+            return
+
+        # it's counted the same way by the task saving it scheduled, so whichever runs second does nothing
+        model.activatePost(post.key)
+        cache.bumpGenerations(blog_slug, cache.postGenerations(post))
+        blog = model.Blog.get_by_id(blog_slug)
+        for path in postPaths(blog, post):
+            pagecache.renderPage(host_url, host, path)
+
 
 class PreviewController(AdminController):
     """ handles showing an admin-only preview of a post """
@@ -385,13 +439,45 @@ class PreviewController(AdminController):
 class CommentsController(AdminController):
     """ handles moderating comments """
 
+    PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    ACTIONS = ["approve", "block", "delete"]
+
     def get(self):
 
-        comments = self.blog.comments.filter(model.BlogComment.approved == False)
+        try:
+            urlsafe = self.request.get("cursor")
+            cursor = Cursor(urlsafe=urlsafe or None)
+        except (datastore_errors.BadValueError, UnicodeDecodeError):
+            return self.renderError(400)
 
-        self.renderTemplate('admin/comments.html', comments=comments, page_title="Admin - Comments", logout_url=self.logout_url)
+        page_size = self.page_size
+        query = self.blog.comments.filter(model.BlogComment.approved == False)
+        comments, next_cursor, more = query.fetch_page(page_size, start_cursor=cursor)
+
+        # look up every post on the page together instead of one at a time for each comment
+        post_keys = list(set([comment.key.parent() for comment in comments]))
+        posts = dict(zip(post_keys, ndb.get_multi(post_keys)))
+
+        next_url = None
+        if more and next_cursor:
+            next_url = "?cursor=" + next_cursor.urlsafe() + "&size=" + str(page_size)
+
+        self.renderTemplate('admin/comments.html', comments=comments, posts=posts, next_url=next_url,
+            first_page=not urlsafe, page_size=page_size, page_title="Admin - Comments", logout_url=self.logout_url)
+
+    @property
+    def page_size(self):
+        size = self.request.get("size")
+        if size.isdigit() and int(size):
+            return min(int(size), self.MAX_PAGE_SIZE)
+        return self.PAGE_SIZE
 
     def post(self):
+
+        action = self.request.get("action")
+        if action:
+            return self.moderate(action)
         
         comment_key = self.request.get("comment")
         if comment_key:
@@ -409,12 +495,15 @@ class CommentsController(AdminController):
                 if block:
                     # also block the IP address
                     blog = self.blog
-                    if comment.ip_address and comment.ip_address not in blog.blocklist:
+                    if comment.ip_address and not blog.blocks(comment.ip_address):
                         blog.blocklist.append(comment.ip_address)
                         blog.put()
+                        cache.bumpBlogVersion(blog.slug)
 
                 if block or self.request.get("delete"):
-                    comment.key.delete()
+                    model.deleteComments([comment])
+                    if comment.approved:
+                        self.bumpPosts([comment])
                     # return them to the post they were viewing if this was deleted from a post page
                     post_slug = self.request.get("post")
                     if post_slug:
@@ -426,16 +515,64 @@ class CommentsController(AdminController):
                         comments = [comment]
                     else:
                         # approve all the comments with the submitted email address here
-                        comments = self.blog.comments.filter(model.BlogComment.email == comment.email)
+                        comments = list(self.blog.comments.filter(model.BlogComment.email == comment.email))
 
                     for comment in comments:
                         comment.approved = True
-                        comment.put()
-                        post_path = self.blog_url + '/post/' + comment.post.slug
-                        memcache.delete(post_path)
+                    model.putComments(comments)
+                    self.bumpPosts(comments)
 
         self.redirect(self.blog_url + '/admin/comments')
 
+    def moderate(self, action):
+        """ approves, deletes, or blocks the addresses of and deletes every selected comment at once """
+        if action not in self.ACTIONS:
+            return self.renderError(400)
+
+        blog = self.blog
+        keys = []
+        for urlsafe in self.request.get_all("comments"):
+            try:
+                key = ndb.Key(urlsafe=urlsafe)
+            except:
+                return self.renderError(400)
+            # only comments from this blog can be moderated here
+            if key.kind() != "BlogComment" or key.root() != blog.key:
+                return self.renderError(400)
+            keys.append(key)
+
+        comments = [comment for comment in ndb.get_multi(keys) if comment]
+
+        if action == "block":
+            addresses = set([comment.ip_address for comment in comments
+                if comment.ip_address and not blog.blocks(comment.ip_address)])
+            if addresses:
+                blog.blocklist.extend(sorted(addresses))
+                blog.put()
+                cache.bumpBlogVersion(blog.slug)
+
+        if action == "approve":
+            for comment in comments:
+                comment.approved = True
+            model.putComments(comments)
+            self.bumpPosts(comments)
+        else:
+            # only approved comments were shown anywhere
+            approved = [comment for comment in comments if comment.approved]
+            model.deleteComments(comments)
+            self.bumpPosts(approved)
+
+        self.redirect(self.blog_url + '/admin/comments?size=' + str(self.page_size))
+
+    def bumpPosts(self, comments):
+        # throw away the cached pages showing the posts of these comments
+        generations = []
+        for post in ndb.get_multi(list(set([comment.key.parent() for comment in comments]))):
+            if post:
+                generations.extend(cache.postGenerations(post))
+        if generations:
+            cache.bumpGenerations(self.blog.slug, generations)
+
 
 class ImagesController(AdminController):
     """ handles managing images """
@@ -537,64 +674,50 @@ class ImageController(AdminController, blobstore_handlers.BlobstoreUploadHandler
 
 
 class MigrateController(AdminController):
-    """ handles running any migrations """
+    """ shows how far each migration has got, and starts them running """
 
     def get(self):
-        return self.renderError(405)
 
-    def post(self):
+        statuses = migrations.getStatuses(self.blog)
 
-        # migrate any images that don't have a url
-        new_images = []
-        for image in self.blog.images:
-            if not image.url:
-                image.url = images.get_serving_url(image.blob)
-                new_images.append(image)
-            elif image.url.startswith('http://'):
-                image.url = image.url.replace('http://', 'https://')
-                new_images.append(image)
-        if new_images:
-            model.ndb.put_multi(new_images)
+        self.renderTemplate('admin/migrate.html', statuses=statuses, page_title="Admin - Migrations", logout_url=self.logout_url)
 
-        self.redirect(self.blog_url + '/admin')
+    def post(self):
 
+        # run all of them unless only some were picked
+        names = self.request.get_all("migration") or [migration.name for migration in migrations.MIGRATIONS]
+        if [name for name in names if name not in migrations.BY_NAME]:
+            return self.renderError(400)
 
-def getCacheKeys(blog):
-    """ lists keys for anything with the blog or its descendents that might be cached """
-    url = '/' + blog.slug
-    keys = [url, url + '/contact', url + '/feed']
-    for post in blog.published_posts:
-        keys.append(url + '/post/' + post.slug)
+        migrations.start(self.blog, names)
 
-    blog_pages = (blog.published_posts.count() - 1) / blog.posts_per_page
-    if blog_pages < 0:
-        blog_pages = 0
+        self.redirect(self.blog_url + '/admin/migrate')
 
-    for page in range(blog_pages):
-        keys.append(url + 'page=' + str(page + 1))
 
-    for author in blog.authors:
-        author_url = (url + '/author/' + author.slug)
-        keys.append(author_url)
+class StatsController(AdminController):
+    """ shows where the time went for the most recent requests to each controller """
 
-        author_pages = (author.published_posts.count() - 1) / blog.posts_per_page
-        if author_pages < 0:
-            author_pages = 0
+    def get(self):
 
-        for page in range(author_pages):
-            keys.append(author_url + 'page=' + str(page + 1))
+        names = set([route.handler.__name__ for route in self.app.router.match_routes])
+        summaries = [(controller, stats.summarize(samples)) for controller, samples in stats.getSamples(names).items()]
+        # the slowest first
+        summaries.sort(key=lambda item: item[1]["p90"], reverse=True)
 
-    return keys
+        self.renderTemplate('admin/stats.html', summaries=summaries, services=stats.SERVICES + [stats.OTHER],
+            page_title="Admin - Stats", logout_url=self.logout_url)
 
 
-def getDatastoreKeys(blog):
+def postPaths(blog, post):
+    """ the paths of the pages that show a live post when they're first requested """
     url = '/' + blog.slug
-    string_keys = [url + '/feed']
-    return [model.ndb.Key('HTMLCache', key) for key in string_keys]
+    paths = [url, url + '/feed', url + '/post/' + post.slug]
+    paths.extend([url + '/tag/' + tag_key.string_id() for tag_key in post.tag_keys])
+    if blog.author_pages:
+        paths.append(url + '/author/' + post.author.string_id())
+    return paths
 
 
 def clearCache(blog):
-    cache_keys = getCacheKeys(blog)
-    memcache.delete_multi(cache_keys)
-    datastore_keys = getDatastoreKeys(blog)
-    ndb.delete_multi(datastore_keys)
+    """ throws away every cached page for the blog """
+    cache.bumpGenerations(blog.slug, [cache.BLOG])
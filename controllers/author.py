@@ -1,13 +1,13 @@
 from base import cacheAndRender
 from index import IndexController
 
-from gae_blog import model
+from gae_blog import cache, model
 
 
 class AuthorController(IndexController):
     """ handles request for an author's page """
 
-    @cacheAndRender()
+    @cacheAndRender(depends=lambda controller, author_slug: [cache.AUTHOR + author_slug])
     def get(self, author_slug):
 
         blog = self.blog
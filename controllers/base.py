@@ -1,35 +1,84 @@
 # the base file and class for all controllers to inherit from
 
 # standard library
+import cgi
 import json
 import logging
+import math
 import os
+import re
+import time
+from calendar import timegm
 from datetime import datetime, timedelta
+from email.utils import formatdate
 from hashlib import sha512
 
 # app engine api imports
-from google.appengine.api import mail, memcache, users
-from google.appengine.ext import deferred
+from google.appengine.api import mail, memcache, taskqueue, users
+from google.appengine.ext import deferred, ndb
 
 # app engine included libraries imports
-import jinja2
 import webapp2
 from webapp2_extras import sessions
 
 # local
-from gae_blog.config import TEMPLATES_PATH
-from gae_blog import model
+from gae_blog.config import DIGEST_QUEUE, DIGEST_LEASE, DIGEST_BATCH, VERIFY_QUEUE, THROTTLE_PERIOD
+from gae_blog import cache, linkbacks, model, stats, throttle
+from gae_blog.templating import makeEnvironment
 
 # see if caching is available
 try:
-    from gae_html import cacheAndRender
+    from gae_html import cacheAndRender as htmlCacheAndRender
+    HTML_CACHE = True
 except ImportError:
-    def cacheAndRender(**top_kwargs):
-        def wrap_action(action):
-            def decorate(*args,  **kwargs):
-                return action(*args, **kwargs)
-            return decorate
-        return wrap_action
+    # otherwise use the built in page cache, which checks the generations of each copy itself
+    from gae_blog import pagecache
+    HTML_CACHE = False
+
+
+def cacheAndRender(depends=None, conditional=True, **top_kwargs):
+    """ caches the page, and throws the cached copy away once anything shown on it has been saved since
+        `depends` is called with the same arguments as the action and returns the generations it uses beyond the blog
+        unless `conditional` is False the page is also given validators made from the generations, so that a client
+        which already has the current page gets a 304 without anything being rendered """
+    def wrap_action(action):
+        if HTML_CACHE:
+            cached_action = htmlCacheAndRender(**top_kwargs)(action)
+        skip_check = top_kwargs.get("skip_check")
+        def decorate(controller, *args, **kwargs):
+            names = [cache.BLOG]
+            if depends:
+                names.extend(depends(controller, *args, **kwargs))
+            page_keys = controller.page_cache_keys
+            current, generations = cache.checkPage(controller.blog_slug, page_keys[-1], names)
+            if cache.refreshBlog(controller.blog_slug, generations.get(cache.VERSION)):
+                # the copy of the blog this request started with is out of date, so the page isn't rendered with it
+                controller.blog_future = cache.getBlogAsync(controller.blog_slug)
+                controller.__dict__.pop("blog", None)
+            # pages with anything particular to the user on them can't be validated by the generations alone
+            if conditional and not controller.user and not (skip_check and skip_check(controller)):
+                if controller.notModified(page_keys[-1], generations):
+                    return
+            if HTML_CACHE and not current:
+                memcache.delete_multi(page_keys)
+                if top_kwargs.get("use_datastore"):
+                    ndb.delete_multi([ndb.Key('HTMLCache', key) for key in page_keys])
+            # kept so that the action can cache anything else that depends on the same generations
+            controller.page_generations = generations
+            if HTML_CACHE:
+                result = cached_action(controller, *args, **kwargs)
+            else:
+                result = pagecache.renderCached(controller, page_keys[-1], generations, action, args, kwargs,
+                    **top_kwargs)
+            if controller.response.status_int != 200:
+                # errors and redirects shouldn't be kept by the client
+                controller.response.headers.pop("ETag", None)
+                controller.response.headers.pop("Last-Modified", None)
+            if HTML_CACHE and not current:
+                cache.savePage(page_keys[-1], generations)
+            return result
+        return decorate
+    return wrap_action
 
 # see if asset management is available
 try:
@@ -39,31 +88,17 @@ except ImportError:
         return url
 
 
-class RelativeEnvironment(jinja2.Environment):
-    """ enable relative template paths """
-
-    def join_path(self, template, parent):
-        return os.path.join(os.path.dirname(parent), template)
-
-
-class RelativeLoader(jinja2.BaseLoader):
-    """ enable relative template paths """
-
-    def get_source(self, environment, template):
-        path = os.path.realpath(os.path.join(TEMPLATES_PATH, template))
-        if not os.path.exists(path):
-            raise jinja2.TemplateNotFound(template)
-        mtime = os.path.getmtime(path)
-        with file(path) as f:
-            source = f.read().decode('utf-8')
-        return source, path, lambda: mtime == os.path.getmtime(path)
-
-
 class BaseController(webapp2.RequestHandler):
 
-    jinja_env = RelativeEnvironment(loader=RelativeLoader())
+    jinja_env = makeEnvironment()
+    page_generations = None # set by cacheAndRender
 
     def dispatch(self):
+        stats.setController(self.__class__.__name__)
+
+        # start looking up the blog straight away so that it can overlap with anything else that's needed
+        self.blog_future
+
         # get a session store for this request
         self.session_store = sessions.get_store(request=self.request)
 
@@ -96,7 +131,10 @@ class BaseController(webapp2.RequestHandler):
         if self.user:
             kwargs["user_is_admin"] = self.user_is_admin
         kwargs["static"] = static
-        return template.render(kwargs)
+        started = time.time()
+        html = template.render(kwargs)
+        stats.addTemplateTime(time.time() - started)
+        return html
 
     def renderTemplate(self, filename, **kwargs):
         if self.request.method != 'HEAD':
@@ -138,6 +176,34 @@ class BaseController(webapp2.RequestHandler):
 
         self.renderError(status_int, stacktrace=stacktrace)
 
+    def notModified(self, page_key, generations):
+        """ sets the validators for a page from the generations it depends on
+            returns True after answering with a 304 if the client already has this version of the page """
+        etag = cache.pageETag(page_key, generations)
+        last_modified = cache.lastModified(generations)
+        if last_modified and timegm(last_modified.timetuple()) >= int(time.time()):
+            # the date is only to the second, so another change later in this one couldn't be told apart from it
+            # and it isn't given out or relied on until the second is over, leaving the ETag to validate the page
+            last_modified = None
+        self.response.headers["ETag"] = '"' + etag + '"'
+        if last_modified:
+            self.response.headers["Last-Modified"] = formatdate(timegm(last_modified.timetuple()), usegmt=True)
+
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match:
+            # this takes priority over the date when both are sent
+            matched = [tag.strip() for tag in if_none_match.split(",") if tag.strip() in ('"' + etag + '"', '*')]
+        else:
+            if_modified_since = self.request.if_modified_since
+            matched = last_modified and if_modified_since and \
+                timegm(last_modified.timetuple()) <= timegm(if_modified_since.utctimetuple())
+
+        if matched:
+            self.response.set_status(304)
+            self.response.clear()
+            return True
+        return False
+
     def getUser(self):
         return users.get_current_user()
 
@@ -152,9 +218,13 @@ class BaseController(webapp2.RequestHandler):
     def user_is_admin(self):
         return self.isUserAdmin()
 
+    @webapp2.cached_property
+    def blog_future(self):
+        return cache.getBlogAsync(self.blog_slug)
+
     @webapp2.cached_property
     def blog(self):
-        return model.Blog.get_by_id(self.blog_slug)
+        return self.blog_future.get_result()
 
     @webapp2.cached_property
     def blog_slug(self):
@@ -164,6 +234,15 @@ class BaseController(webapp2.RequestHandler):
     def blog_url(self):
         return '/' + self.blog_slug
 
+    @webapp2.cached_property
+    def page_cache_keys(self):
+        # every key this page might be cached under, so that each query string variant is covered
+        path = self.request.path
+        keys = [path]
+        if self.request.query_string:
+            keys.extend([path + self.request.query_string, self.request.path_qs])
+        return keys
+
     def errorsFromSession(self):
         form_data = self.session.pop("form_data", {})
         errors = self.session.pop("errors", {})
@@ -179,8 +258,15 @@ class BaseController(webapp2.RequestHandler):
     def deferEmail(self, to, subject, body, reply_to=None, **kwargs):
         deferred.defer(self.sendEmail, self.blog.admin_email, to, subject, body, reply_to=reply_to, _queue=self.blog.mail_queue)
 
+    @webapp2.cached_property
+    def comments_url(self):
+        return self.request.host_url + self.blog_url + "/admin/comments"
+
     def linkbackEmail(self, post, comment):
-        blog = self.blog
+        self.moderationAlert(self.blog, post, comment, self.comments_url)
+
+    @classmethod
+    def moderationAlert(cls, blog, post, comment, comments_url):
         if blog.moderation_alert and blog.admin_email:
             # send out an email to the author of the post if they have an email address
             # informing them of the comment needing moderation
@@ -194,13 +280,104 @@ class BaseController(webapp2.RequestHandler):
                     linkback = "Webmention"
                 else:
                     linkback = "Comment"
-                if blog.title:
-                    subject = blog.title + " - " + linkback + " Awaiting Moderation"
+                if blog.digest_interval:
+                    cls.queueDigest(blog, post, author, linkback, comments_url)
                 else:
-                    subject = "Blog - " + linkback + " Awaiting Moderation"
-                comments_url = self.request.host_url + self.blog_url + "/admin/comments"
-                body = "A " + linkback + " on your post \"" + post.title + "\" is waiting to be approved or denied at " + comments_url
-                self.deferEmail(author.name + " <" + author.email + ">", subject, body)
+                    if blog.title:
+                        subject = blog.title + " - " + linkback + " Awaiting Moderation"
+                    else:
+                        subject = "Blog - " + linkback + " Awaiting Moderation"
+                    body = "A " + linkback + " on your post \"" + post.title + "\" is waiting to be approved or denied at " + comments_url
+                    deferred.defer(cls.sendEmail, blog.admin_email, author.name + " <" + author.email + ">", subject, body,
+                        _queue=blog.mail_queue)
+
+    @classmethod
+    def queueDigest(cls, blog, post, author, linkback, comments_url):
+        # the alert waits on a pull queue for the digest that covers the current interval
+        payload = json.dumps({"linkback": linkback, "title": post.title})
+        taskqueue.Queue(DIGEST_QUEUE).add(taskqueue.Task(payload=payload, method="PULL", tag=author.key.urlsafe()))
+
+        # naming the digest after its interval means it's only added once however many alerts there are
+        interval = blog.digest_interval * 60
+        end = (int(time.time()) / interval + 1) * interval
+        name = re.sub(r'[^a-zA-Z0-9-]', '_', "-".join(["digest", blog.slug, author.slug, str(end)]))
+        try:
+            deferred.defer(cls.sendDigest, blog.slug, author.key, comments_url, _name=name,
+                _eta=datetime.utcfromtimestamp(end), _queue=blog.mail_queue)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    @classmethod
+    def sendDigest(cls, blog_slug, author_key, comments_url):
+        """ sends an author one email for all the alerts that have been queued for them """
+        queue = taskqueue.Queue(DIGEST_QUEUE)
+        tasks = []
+        while True:
+            leased = queue.lease_tasks_by_tag(DIGEST_LEASE, DIGEST_BATCH, tag=author_key.urlsafe())
+            tasks.extend(leased)
+            if len(leased) < DIGEST_BATCH:
+                break
+
+        if not tasks:
+            return
+
+        blog, author = ndb.get_multi([ndb.Key(model.Blog, blog_slug), author_key])
+        if blog and blog.admin_email and author and author.email:
+            counts = {}
+            titles = {}
+            for task in tasks:
+                alert = json.loads(task.payload)
+                counts[alert["linkback"]] = counts.get(alert["linkback"], 0) + 1
+                titles[alert["title"]] = titles.get(alert["title"], 0) + 1
+
+            subject = (blog.title or "Blog") + " - " + str(len(tasks)) + " Awaiting Moderation"
+            body = "These are waiting to be approved or denied at " + comments_url + "\n\n"
+            body += "\n".join([str(count) + " " + linkback for linkback, count in sorted(counts.items())])
+            body += "\n\nOn these posts:\n\n"
+            body += "\n".join(["\"" + title + "\" (" + str(count) + ")" for title, count in sorted(titles.items())])
+            cls.sendEmail(blog.admin_email, author.name + " <" + author.email + ">", subject, body)
+
+        for i in range(0, len(tasks), DIGEST_BATCH):
+            queue.delete_tasks(tasks[i:i + DIGEST_BATCH])
+
+    def deferVerification(self, comment, target):
+        # the source is fetched by a task so that the response doesn't have to wait for it
+        deferred.defer(self.verifyLinkback, comment, target, self.comments_url, _queue=VERIFY_QUEUE)
+
+    @classmethod
+    def verifyLinkback(cls, comment, target, comments_url):
+        """ saves a new linkback once its source is found to link to the target, otherwise it's dropped """
+        found = linkbacks.verify(comment.url, target)
+        if not found:
+            return
+
+        if found.title and not comment.name:
+            comment.name = found.title
+        if found.excerpt and not comment.body:
+            comment.body = cgi.escape(found.excerpt)
+
+        post = comment.key.parent().get()
+        # the receipt stops this from being saved twice if the same linkback was sent again while it was verified
+        if post and post.published and model.putLinkback(comment):
+            cls.moderationAlert(post.blog, post, comment, comments_url)
+
+
+    def overBudget(self):
+        """ takes a write from the budgets for this address and the whole blog, returning True if either has run out """
+        blog = self.blog
+        limits = [(throttle.IP, blog.ip_write_budget), (throttle.BLOG, blog.blog_write_budget)]
+        for limit, budget in limits:
+            if not budget:
+                continue
+            key = "|".join([blog.slug, limit])
+            if limit == throttle.IP:
+                key += "|" + (self.request.remote_addr or "")
+            if not throttle.consume(key, budget):
+                throttle.fired(blog.slug, limit)
+                # how long until the bucket has refilled enough for another write
+                self.response.headers["Retry-After"] = str(int(math.ceil(THROTTLE_PERIOD / float(budget))))
+                return True
+        return False
 
 
 class FormController(BaseController):
@@ -233,6 +410,13 @@ class FormController(BaseController):
         self.session["errors"] = errors
         self.redirect(url)
 
+    def throttled(self):
+        # returns if the request has been refused for going over a write budget
+        if self.overBudget():
+            self.renderError(503)
+            return True
+        return False
+
     def botProtection(self, url):
         # returns if the request is suspected of being a bot or not
         try:
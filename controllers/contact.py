@@ -9,7 +9,8 @@ class ContactController(FormController):
 
     FIELDS = {"author": validateRequiredString, "email": validateRequiredEmail, "subject": validateString, "body": validateRequiredText}
 
-    @cacheAndRender(skip_check=lambda controller: 'errors' in controller.session)
+    # whether a message was just sent is kept in the session
+    @cacheAndRender(conditional=False, skip_check=lambda controller: 'errors' in controller.session)
     def get(self):
 
         blog = self.blog
@@ -35,6 +36,8 @@ class ContactController(FormController):
                 self.session["blog_contact_sent"] = True
                 return
 
+            if self.throttled(): return
+
             # validation and handling
             form_data, errors, valid_data = self.validate()
 
@@ -1,41 +1,67 @@
 from datetime import datetime
 
+from google.appengine.ext import ndb
+
 from base import BaseController, cacheAndRender
 
-from gae_blog import model
+from gae_blog import cache, model
 
 
 class FeedController(BaseController):
     """ handles request for news feeds like RSS """
 
+    RESULTS_KEY = "GAE_BLOG_FEED_RESULTS"
+
     # the minifier does not play nice with RSS - CDATA is not handled properly
     # `use_datastore` adds another layer of caching instead of having to render this each time
-    @cacheAndRender(minify=False, use_datastore=True, content_type='application/rss+xml; charset=UTF-8')
+    @cacheAndRender(depends=lambda controller: [cache.POSTS], minify=False, use_datastore=True, content_type='application/rss+xml; charset=UTF-8')
     def get(self):
 
         root_url = self.request.headers.get('host')
 
-        blog = self.blog
+        blog, author, tag, posts = self.getFeedAsync().get_result()
+
+        self.response.headers['Content-Type'] = 'application/rss+xml; charset=UTF-8'
+
+        self.renderTemplate('feed.rss', blog=blog, author=author, tag=tag,
+            posts=posts, root_url=root_url, build_date=datetime.utcnow())
+
+    @ndb.tasklet
+    def getFeedAsync(self):
+        # the author and tag keys are known from the request, so they're looked up alongside the blog
+        blog_key = ndb.Key(model.Blog, self.blog_slug)
+        author_slug = self.request.get("author")
+        tag_slug = self.request.get("tag")
+
+        author_future = tag_future = None
+        if author_slug:
+            author_future = model.BlogAuthor.get_by_id_async(author_slug, parent=blog_key)
+        if tag_slug:
+            tag_future = model.BlogTag.get_by_id_async(tag_slug, parent=blog_key)
+
+        blog = yield self.blog_future
         author = None
         tag = None
         posts = []
         if blog:
             entity = blog
-            author_slug = self.request.get("author")
             if author_slug and blog.author_pages:
-                author = model.BlogAuthor.get_by_id(author_slug, parent=blog.key)
+                author = yield author_future
                 if author:
                     entity = author
-            else:
-                tag_slug = self.request.get("tag")
-                if tag_slug:
-                    tag = model.BlogTag.get_by_id(tag_slug, parent=blog.key)
-                    if tag:
-                        entity = tag
+            elif tag_slug:
+                tag = yield tag_future
+                if tag:
+                    entity = tag
 
-            posts = entity.published_posts.fetch(blog.posts_per_page)
+            # summaries only need the cards, which leave out the body of each post
+            cards = blog.summaries
+            query = model.publishedPosts(entity, cutoff=blog.publish_cutoff)
+            # the posts found stay the same until the feed's generations change or the next scheduled post goes live
+            query_key = "|".join([entity.key.urlsafe(), str(cards), str(blog.posts_per_page)])
+            results_key = self.RESULTS_KEY + "|" + cache.pageETag(query_key, self.page_generations)
+            posts, cursor, more = yield model.fetchPublishedPageAsync(query, blog.posts_per_page, results_key,
+                model.publishedCacheTime(blog), cards=cards)
+            yield model.prefetchPostsAsync(posts)
 
-        self.response.headers['Content-Type'] = 'application/rss+xml; charset=UTF-8'
-
-        self.renderTemplate('feed.rss', blog=blog, author=author, tag=tag,
-            posts=posts, root_url=root_url, build_date=datetime.utcnow())
+        raise ndb.Return((blog, author, tag, posts))
@@ -1,27 +1,32 @@
 import math
-from datetime import datetime
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 
 from base import BaseController, cacheAndRender
 from gae_blog.lib.gae_validators import validateInt
 
-from gae_blog import model
+from gae_blog import cache, model
 
 
 class IndexController(BaseController):
     """ handles request for the main index page of the site """
 
-    @cacheAndRender()
+    CURSOR_KEY = "GAE_BLOG_CURSOR"
+    CURSOR_EXPIRES = 3600 # seconds
+    RESULTS_KEY = "GAE_BLOG_RESULTS"
+
+    @cacheAndRender(depends=lambda controller: [cache.POSTS])
     def get(self):
 
-        blog = self.blog
+        blog, result = self.getIndexAsync().get_result()
 
         page = 0
         last_page = 0
         posts = []
 
         if blog:
-            result = self.getPaginatedPosts(blog, blog.posts_per_page, self.blog_slug)
-
             if self.response.status_int != 200:
                 return
 
@@ -29,21 +34,41 @@ class IndexController(BaseController):
 
         self.renderTemplate('index.html', page=page, last_page=last_page, posts=posts, len=len)
 
+    @ndb.tasklet
+    def getIndexAsync(self):
+        # the post count only needs the blog's key, so it can be looked up at the same time as the blog
+        blog_key = ndb.Key(model.Blog, self.blog_slug)
+        blog, count = yield self.blog_future, model.getCountAsync(blog_key, model.PUBLISHED_POSTS)
+
+        result = None
+        if blog:
+            result = yield self.getPaginatedPostsAsync(blog, blog.posts_per_page, self.blog_slug, count=count)
+
+        raise ndb.Return((blog, result))
 
     def getPaginatedPosts(self, entity, posts_per_page, redirect_url):
-        published_posts = entity.published_posts
+        return self.getPaginatedPostsAsync(entity, posts_per_page, redirect_url).get_result()
+
+    @ndb.tasklet
+    def getPaginatedPostsAsync(self, entity, posts_per_page, redirect_url, count=None):
+        # summaries only need the cards, which leave out the body of each post
+        cards = self.blog.summaries
 
-        last_page = int(math.ceil(published_posts.count() / float(posts_per_page)))
+        if count is None:
+            count = yield model.getCountAsync(entity.key, model.PUBLISHED_POSTS)
+        last_page = int(math.ceil(count / float(posts_per_page)))
         
         try:
             page_str = self.request.get("page")
         except UnicodeDecodeError:
-            return self.renderError(400)
+            self.renderError(400)
+            raise ndb.Return(None)
         
         try:
             order = self.request.get("order")
         except UnicodeDecodeError:
-            return self.renderError(400)
+            self.renderError(400)
+            raise ndb.Return(None)
 
         page = 0
         if page_str:
@@ -51,23 +76,72 @@ class IndexController(BaseController):
 
             # don't want this for SEO purposes
             if not page:
-                return self.redirect(redirect_url, permanent=True)
+                self.redirect(redirect_url, permanent=True)
+                raise ndb.Return(None)
             # and these don't exist yet
             if page >= last_page:
-                return self.renderError(404)
+                self.renderError(404)
+                raise ndb.Return(None)
         else:
             page = last_page
         
+        cutoff = self.blog.publish_cutoff
         if order == 'asc':
-            now = datetime.utcnow()
-            published_posts = entity.posts.filter(model.BlogPost.published == True) \
-                .filter(model.BlogPost.timestamp < now).order(model.BlogPost.timestamp)
+            published_posts = model.publishedPosts(entity, ascending=True, cutoff=cutoff)
+        else:
+            order = 'desc'
+            published_posts = model.publishedPosts(entity, cutoff=cutoff)
 
         posts = []
         if page:
             # invert the offset so that pages increase as time goes on
             offset_page = last_page - page
 
-            posts = published_posts.fetch(posts_per_page, offset=offset_page * posts_per_page)
+            # the count and cutoff are part of the key so that adding or removing a post doesn't reuse old boundaries
+            cursor_prefix = "|".join([self.CURSOR_KEY, entity.key.urlsafe(), str(cards), order,
+                str(posts_per_page), str(count), str(self.blog.next_publish)])
+            posts = yield self.fetchPageAsync(published_posts, cursor_prefix, offset_page, posts_per_page,
+                cache_time=model.publishedCacheTime(self.blog), cards=cards)
+            yield model.prefetchPostsAsync(posts)
+
+        raise ndb.Return((page, last_page, posts))
+
+    def fetchPage(self, query, cursor_prefix, page_index, page_size, cache_time=None, cards=False):
+        return self.fetchPageAsync(query, cursor_prefix, page_index, page_size, cache_time=cache_time,
+            cards=cards).get_result()
+
+    @ndb.tasklet
+    def fetchPageAsync(self, query, cursor_prefix, page_index, page_size, cache_time=None, cards=False):
+        """ fetches a single page of results, starting from the cursor cached at its boundary if there is one
+            so that deep pages don't have to skip over every result before them
+            with a `cache_time` the results are kept for other requests until the page's generations change
+            and with `cards` the posts' cards are returned instead of the posts """
+        context = ndb.get_context()
+        results_key = None
+        if self.page_generations:
+            results_key = self.RESULTS_KEY + "|" + cache.pageETag(cursor_prefix + "|" + str(page_index),
+                self.page_generations)
+        start_cursor = None
+        offset = page_index * page_size
+        if page_index:
+            urlsafe = yield context.memcache_get(cursor_prefix + "|" + str(page_index))
+            if urlsafe:
+                try:
+                    start_cursor = Cursor(urlsafe=urlsafe)
+                    offset = 0
+                except datastore_errors.BadValueError:
+                    pass
 
-        return page, last_page, posts
+        try:
+            results, cursor, more = yield model.fetchPublishedPageAsync(query, page_size, results_key, cache_time,
+                cards=cards, start_cursor=start_cursor, offset=offset)
+        except datastore_errors.BadRequestError:
+            # the cursor no longer applies to this query, so fall back to skipping to the page
+            results, cursor, more = yield model.fetchPublishedPageAsync(query, page_size, cards=cards,
+                offset=page_index * page_size)
+
+        if more and cursor:
+            # remember where the next page starts for whoever asks for it
+            yield context.memcache_set(cursor_prefix + "|" + str(page_index + 1), cursor.urlsafe(), time=self.CURSOR_EXPIRES)
+
+        raise ndb.Return(results)
@@ -22,8 +22,10 @@ class PingbackController(BaseController):
 
         if not blog:
             result = xmlrpclib.Fault(32, 'Blog Not Found')
-        elif not blog.enable_linkbacks or ip_address in blog.blocklist:
+        elif not blog.enable_linkbacks or blog.blocks(ip_address):
             result = xmlrpclib.Fault(49, 'Access Denied')
+        elif self.overBudget():
+            result = xmlrpclib.Fault(0, 'Too Many Requests')
         else:
             params, methodname = xmlrpclib.loads(self.request.body)
             
@@ -50,19 +52,17 @@ class PingbackController(BaseController):
                         # only allow pingbacking to a post if it's actually published
                         if not post or not post.published:
                             result = xmlrpclib.Fault(33, 'Post Not Found')
-                        else:
-                            # look for a comment from this URL address on this blog already (redundancy check)
-                            exists = post.comments.filter(model.BlogComment.url == source).filter(model.BlogComment.pingback == True)
-                            if exists.count():
-                                result = xmlrpclib.Fault(48, 'Pingback Already Registered')
+                        # look for a pingback from this URL on this post already (redundancy check)
+                        elif model.linkbackReceiptKey(post.key, "pingback", source).get():
+                            result = xmlrpclib.Fault(48, 'Pingback Already Registered')
                         
                 if not result:
                     comment = model.BlogComment(url=source, pingback=True, ip_address=ip_address, parent=post.key)
-                    comment.put()
 
-                    result = ('Pingback Receieved Successfully',)
+                    # it's only saved once the source is found to link to the target
+                    self.deferVerification(comment, target)
 
-                    self.linkbackEmail(post, comment)
+                    result = ('Pingback Receieved Successfully',)
 
         xml = xmlrpclib.dumps(result, methodresponse=True)
 
@@ -1,9 +1,9 @@
-from google.appengine.api import memcache
+from google.appengine.ext import ndb
 
 from base import FormController, cacheAndRender
 
 from gae_blog.lib.gae_validators import validateBool, validateString, validateText, validateEmail, validateUrl
-from gae_blog import model
+from gae_blog import cache, model
 
 
 class PostController(FormController):
@@ -25,12 +25,12 @@ class PostController(FormController):
                 self.response.headers.add("X-Pingback", root_url + "/pingback")
                 self.response.headers.add("Link", '<' + root_url + '/webmention>; rel="webmention"')
 
-    @cacheAndRender(include_comments=True, skip_check=lambda controller: 'errors' in controller.session)
+    @cacheAndRender(depends=lambda controller, post_slug: [cache.POST + post_slug], include_comments=True, skip_check=lambda controller: 'errors' in controller.session)
     def get(self, post_slug):
 
-        if post_slug and self.blog:
-            post = model.BlogPost.get_by_id(post_slug, parent=self.blog.key)
-            if post and post.published:
+        if post_slug:
+            blog, post = self.getPostAsync(post_slug).get_result()
+            if blog and post and post.published:
                 # only display a post if it's actually published
                 form_data, errors = self.errorsFromSession()
 
@@ -42,19 +42,37 @@ class PostController(FormController):
 
         return self.renderError(404)
 
+    @ndb.tasklet
+    def getPostAsync(self, post_slug):
+        # the post's key is known from the URL, so it and its comments can be looked up alongside the blog
+        post_key = ndb.Key(model.BlogPost, post_slug, parent=ndb.Key(model.Blog, self.blog_slug))
+        comments_query = model.BlogComment.query(ancestor=post_key).filter(model.BlogComment.approved == True) \
+            .order(model.BlogComment.timestamp)
+
+        blog, post, comments = yield self.blog_future, post_key.get_async(), comments_query.fetch_async()
+
+        if blog and post and post.published:
+            # authors of comments are looked up now so that rendering finds them in the context cache
+            author_keys = list(set([comment.author for comment in comments if comment.author]))
+            yield [model.prefetchPostsAsync([post])] + ndb.get_multi_async(author_keys)
+            post._prefetched["approved_comments"] = comments
+
+        raise ndb.Return((blog, post))
+
     def post(self, post_slug):
 
         ip_address = self.request.remote_addr
         blog = self.blog
-        if blog and blog.enable_comments and ip_address not in blog.blocklist:
+        if blog and blog.enable_comments and not blog.blocks(ip_address):
             # only allow comment posting if comments are enabled
             if post_slug:
                 post = model.BlogPost.get_by_id(post_slug, parent=blog.key)
                 if post and post.published:
                     # only allow commenting to a post if it's actually published
 
+                    # admins don't use up the budget that everyone else shares
                     bot = self.botProtection('/post/' + post_slug)
-                    if bot: return
+                    if bot or (not self.user_is_admin and self.throttled()): return
 
                     form_data, errors, valid_data = self.validate()
 
@@ -83,7 +101,6 @@ class PostController(FormController):
 
                         if not errors:
                             comment = model.BlogComment(body=body, approved=True, author=author.key, parent=post.key)
-                            memcache.delete(self.request.path)
                     else:
                         # trackbacks require URLs, normal comments require emails if not from an author
                         if valid_linkback:
@@ -120,11 +137,19 @@ class PostController(FormController):
 
                         if approved.count():
                             comment.approved = True
-                            memcache.delete(self.request.path)
-                        else:
-                            self.linkbackEmail(post, comment)
 
-                    comment.put()
+                    if comment.linkback:
+                        # saved with a receipt so that the source can't link back the same way again
+                        if not model.putLinkback(comment):
+                            errors["url"] = True
+                            return self.redisplay(form_data, errors, self.blog_url + '/post/' + post_slug + '#comment-link')
+                    else:
+                        model.putComments([comment])
+
+                    if comment.approved:
+                        cache.bumpGenerations(blog.slug, cache.postGenerations(post))
+                    else:
+                        self.linkbackEmail(post, comment)
 
                     return self.redirect(self.blog_url + '/post/' + post_slug + '#comments')
 
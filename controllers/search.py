@@ -0,0 +1,41 @@
+import math
+import urllib
+
+from base import BaseController
+
+from gae_blog.lib.gae_validators import validateInt
+from gae_blog import model
+
+
+class SearchController(BaseController):
+    """ handles searching the published posts """
+
+    # not cached since there's no end to the different queries
+
+    def get(self):
+
+        blog = self.blog
+        if not blog:
+            return self.renderError(403)
+
+        try:
+            query = self.request.get("q").strip()
+            page_str = self.request.get("page")
+        except UnicodeDecodeError:
+            return self.renderError(400)
+
+        page = 0
+        if page_str:
+            valid, page = validateInt(page_str)
+            if not valid or page < 0:
+                return self.renderError(404)
+
+        total, posts = model.searchPosts(blog, query, page, blog.posts_per_page)
+        last_page = max(int(math.ceil(total / float(blog.posts_per_page))) - 1, 0)
+        if page > last_page:
+            return self.renderError(404)
+
+        search_url = self.blog_url + '/search?' + urllib.urlencode({"q": query.encode('utf-8')})
+
+        self.renderTemplate('search.html', query=query, total=total, posts=posts, page=page, last_page=last_page,
+            search_url=search_url, page_title="Search")
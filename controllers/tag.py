@@ -1,13 +1,13 @@
 from base import cacheAndRender
 from index import IndexController
 
-from gae_blog import model
+from gae_blog import cache, model
 
 
 class TagController(IndexController):
     """ handles request for an author's page """
 
-    @cacheAndRender()
+    @cacheAndRender(depends=lambda controller, tag_slug: [cache.TAG + tag_slug])
     def get(self, tag_slug):
 
         blog = self.blog
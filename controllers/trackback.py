@@ -22,8 +22,10 @@ class TrackbackController(FormController):
 
         if not blog:
             error = 'There is no blog at this URL.'
-        elif not blog.enable_linkbacks or ip_address in blog.blocklist:
+        elif not blog.enable_linkbacks or blog.blocks(ip_address):
             error = 'This blog does not have trackbacks enabled.'
+        elif self.overBudget():
+            error = 'Too many requests, please try again later.'
         elif not post_slug:
             error = 'Missing post ID.'
         else:
@@ -49,11 +51,10 @@ class TrackbackController(FormController):
                             excerpt = excerpt.replace("\r\n", "<br/>")
 
                     url = valid_data["url"]
-                    if url:
-                        # look for a comment from this URL address on this blog already (redundancy check)
-                        exists = post.comments.filter(model.BlogComment.url == url).filter(model.BlogComment.trackback == True)
-                        if exists.count():
-                            error = 'This trackback already exists.'
+
+                    # look for a trackback from this URL on this post already (redundancy check)
+                    if model.linkbackReceiptKey(post.key, "trackback", url).get():
+                        error = 'This trackback already exists.'
 
                 if not error:
                     comment = model.BlogComment(url=url, trackback=True, ip_address=ip_address, parent=post.key)
@@ -65,8 +66,7 @@ class TrackbackController(FormController):
                     if valid_data["blog_name"]:
                         comment.blog_name = valid_data["blog_name"]
 
-                    comment.put()
-
-                    self.linkbackEmail(post, comment)
+                    # it's only saved once the source is found to link to the post
+                    self.deferVerification(comment, self.request.host_url + self.blog_url + '/post/' + post_slug)
 
         self.renderTemplate('trackback.xml', error=error)
@@ -19,8 +19,10 @@ class WebmentionController(BaseController):
 
         if not blog:
             self.renderError(404)
-        elif not blog.enable_linkbacks or ip_address in blog.blocklist:
+        elif not blog.enable_linkbacks or blog.blocks(ip_address):
             self.renderError(403)
+        elif self.overBudget():
+            self.renderError(503)
         else:
             source = self.request.get("source")
             target = self.request.get("target")
@@ -41,16 +43,14 @@ class WebmentionController(BaseController):
                     # only allow webmentions to a post if it's actually published
                     if not post or not post.published:
                         self.renderError(404)
+                    # look for a webmention from this URL on this post already (redundancy check)
+                    elif model.linkbackReceiptKey(post.key, "webmention", source).get():
+                        self.renderError(400)
                     else:
-                        # look for a comment from this URL address on this blog already (redundancy check)
-                        exists = post.comments.filter(model.BlogComment.url == source).filter(model.BlogComment.webmention == True)
-                        if exists.count():
-                            self.renderError(400)
-                        else:
-                            comment = model.BlogComment(url=source, webmention=True, ip_address=ip_address, parent=post.key)
-                            comment.put()
-
-                            self.linkbackEmail(post, comment)
-
-                            self.response.set_status(202) # Accepted
-                            self.response.out.write("Awaiting Moderation")
+                        comment = model.BlogComment(url=source, webmention=True, ip_address=ip_address, parent=post.key)
+
+                        # it's only saved once the source is found to link to the target
+                        self.deferVerification(comment, target)
+
+                        self.response.set_status(202) # Accepted
+                        self.response.out.write("Awaiting Moderation")
@@ -0,0 +1,138 @@
+# verifies that the source of a linkback really links to the post it claims to, before the linkback is saved
+
+import logging
+import re
+import urlparse
+from HTMLParser import HTMLParser, HTMLParseError
+
+from google.appengine.api import urlfetch
+
+from gae_blog.config import VERIFY_TIMEOUT, VERIFY_MAX_BYTES
+
+CHUNK_SIZE = 8192 # bytes fed to the parser at a time
+EXCERPT_CHARS = 150 # on either side of the link
+TITLE_CHARS = 500 # the most that fits in an indexed string
+
+
+def fetchUrl(url):
+    """ fetches a page, returning the status code and the start of its content, or None if it couldn't be fetched
+        urlfetch always reads the whole response, so the time it takes is bounded by the deadline rather than its size """
+    try:
+        # most servers honour the range and send no more than is parsed, and for the ones that don't
+        # everything beyond it is cut off here
+        response = urlfetch.fetch(url, headers={"Range": "bytes=0-" + str(VERIFY_MAX_BYTES - 1)},
+            deadline=VERIFY_TIMEOUT, follow_redirects=True)
+    except urlfetch.Error, e:
+        logging.info("couldn't fetch linkback source %s: %s", url, e)
+        return None
+    return response.status_code, response.content[:VERIFY_MAX_BYTES]
+
+# this can be replaced with anything that takes a URL and returns the same as fetchUrl, like a fake for testing
+fetcher = fetchUrl
+
+
+def normalizeUrl(url):
+    # http and https, a trailing slash, and a fragment don't make it a different page
+    parts = urlparse.urlsplit(url.strip())
+    normalized = parts.netloc.lower() + (parts.path.rstrip("/") or "")
+    if parts.query:
+        normalized += "?" + parts.query
+    return normalized
+
+
+class SourceParser(HTMLParser):
+    """ looks for a link to the target, along with the page's title and the text around the link
+        it's fed a piece at a time so that it can stop as soon as it's found everything """
+
+    SKIP_TAGS = ("script", "style")
+    # these separate words, so a space is added for them to stop text running together in the excerpt
+    BLOCK_TAGS = ("p", "div", "br", "li", "td", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "article", "section")
+
+    def __init__(self, target):
+        HTMLParser.__init__(self)
+        self.target = normalizeUrl(target)
+        self.linked = False
+        self.title = u""
+        self.before = u""
+        self.after = u""
+        self.in_title = False
+        self.skipping = 0
+
+    @property
+    def done(self):
+        return self.linked and len(self.after) >= EXCERPT_CHARS
+
+    @property
+    def excerpt(self):
+        text = re.sub(r"\s+", " ", self.before + self.after).strip()
+        return text and u"[...] " + text + u" [...]" or u""
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.handle_data(" ")
+        if tag == "title":
+            self.in_title = True
+        elif tag in self.SKIP_TAGS:
+            self.skipping += 1
+        elif tag == "a" and not self.linked:
+            href = dict(attrs).get("href")
+            if href and normalizeUrl(href) == self.target:
+                self.linked = True
+
+    def handle_endtag(self, tag):
+        if tag in self.BLOCK_TAGS:
+            self.handle_data(" ")
+        if tag == "title":
+            self.in_title = False
+        elif tag in self.SKIP_TAGS and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title = (self.title + data)[:TITLE_CHARS]
+        elif not self.skipping:
+            if self.linked:
+                self.after = (self.after + data)[:EXCERPT_CHARS]
+            else:
+                self.before = (self.before + data)[-EXCERPT_CHARS:]
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape("&" + name + ";"))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape("&#" + name + ";"))
+
+
+def parseSource(content, target):
+    """ returns a parser that's read as much of the content as it needs to """
+    parser = SourceParser(target)
+    if isinstance(content, str):
+        content = content.decode("utf-8", "replace")
+    try:
+        for i in range(0, len(content), CHUNK_SIZE):
+            parser.feed(content[i:i + CHUNK_SIZE])
+            if parser.done:
+                break
+    except HTMLParseError:
+        # whatever was found before the page stopped making sense still counts
+        pass
+    parser.title = re.sub(r"\s+", " ", parser.title).strip()
+    return parser
+
+
+def verify(source, target):
+    """ fetches the source and returns a parser with what was found if it links to the target, otherwise None """
+    fetched = fetcher(source)
+    if not fetched:
+        return None
+
+    status, content = fetched
+    if status not in (200, 206):
+        logging.info("linkback source %s returned %s", source, status)
+        return None
+
+    parser = parseSource(content, target)
+    if not parser.linked:
+        logging.info("linkback source %s doesn't link to %s", source, target)
+        return None
+    return parser
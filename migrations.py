@@ -0,0 +1,215 @@
+# changes to the data saved by older versions, each run by a chain of tasks a batch at a time
+
+from abc import ABCMeta, abstractmethod
+
+from google.appengine.api import images
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred, ndb
+
+from gae_blog.config import MIGRATION_BATCH, SEARCH_QUEUE
+from gae_blog import cache, model
+
+# states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+
+
+class BlogMigration(ndb.Model):
+    """ how far a migration has got for a blog, a child of the blog keyed by the migration's name
+        it's saved in the same transaction as each batch, so a task that's retried carries on from the last batch """
+
+    state = ndb.StringProperty(default=QUEUED)
+    cursor = ndb.StringProperty(indexed=False)
+    step = ndb.IntegerProperty(default=0, indexed=False) # stops a task that ran twice from doing its batch twice
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class Migration(object):
+    """ a named change made to everything a query finds in a blog """
+
+    __metaclass__ = ABCMeta
+
+    name = None
+    description = None
+    batch = MIGRATION_BATCH
+
+    @abstractmethod
+    def query(self, blog):
+        """ what's changed, which must be in the blog's entity group """
+
+    def start(self, blog):
+        # anything to do before the first batch
+        pass
+
+    @abstractmethod
+    def migrate(self, blog, entities):
+        """ changes and saves a batch, from within a transaction on the blog """
+
+
+class ImageURLs(Migration):
+
+    name = "image_urls"
+    description = "Serving URLs for images uploaded before they were saved, and HTTPS for older ones"
+
+    def query(self, blog):
+        return blog.images
+
+    def migrate(self, blog, entities):
+        urls = [image.url for image in entities]
+
+        # the serving URLs are all asked for at once rather than waiting for each one in turn
+        missing = [image for image in entities if not image.url]
+        rpcs = [images.get_serving_url_async(image.blob) for image in missing]
+        for image, rpc in zip(missing, rpcs):
+            image.url = rpc.get_result()
+
+        for image in entities:
+            if image.url.startswith('http://'):
+                image.url = image.url.replace('http://', 'https://')
+
+        ndb.put_multi([image for image, url in zip(entities, urls) if image.url != url])
+
+
+class PostCounts(Migration):
+
+    name = "post_counts"
+    description = "Published post counts for the blog, its authors and tags, and when its next scheduled post goes live"
+
+    def query(self, blog):
+        return blog.posts
+
+    def start(self, blog):
+        model.deleteCounters(blog, [model.PUBLISHED_POSTS])
+        if model.updateNextPublish(blog.key):
+            model.bumpBlog(blog.key)
+
+    def migrate(self, blog, entities):
+        model.recountPosts(entities)
+
+
+class CommentCounts(Migration):
+
+    name = "comment_counts"
+    description = "Comment and linkback counts for each post"
+
+    def query(self, blog):
+        return blog.comments
+
+    def start(self, blog):
+        model.deleteCounters(blog, [model.COMMENTS, model.LINKBACKS])
+
+    def migrate(self, blog, entities):
+        model.recountComments(entities)
+
+
+class Summaries(Migration):
+
+    name = "summaries"
+    description = "Excerpts and reading times for posts saved before they were stored, and the cards used to list posts"
+
+    def query(self, blog):
+        return blog.posts
+
+    def migrate(self, blog, entities):
+        summarized = [post for post in entities if post.word_count is None]
+        for post in summarized:
+            post.updateSummary()
+        ndb.put_multi(summarized + [post.card for post in entities])
+
+
+class SearchIndex(Migration):
+
+    name = "search_index"
+    description = "The search index, rebuilt from scratch"
+
+    def query(self, blog):
+        return blog.posts
+
+    def start(self, blog):
+        model.clearIndex(blog)
+
+    def migrate(self, blog, entities):
+        # the search queue adds them to the index one at a time
+        for post in entities:
+            deferred.defer(model.indexPost, post.key, _queue=SEARCH_QUEUE)
+
+
+class Receipts(Migration):
+
+    name = "receipts"
+    description = "Receipts used to find duplicate linkbacks, for linkbacks saved before they existed"
+
+    def query(self, blog):
+        return blog.comments
+
+    def migrate(self, blog, entities):
+        model.putReceipts(entities)
+
+
+# in the order they run in
+MIGRATIONS = [ImageURLs(), PostCounts(), CommentCounts(), Summaries(), SearchIndex(), Receipts()]
+BY_NAME = dict([(migration.name, migration) for migration in MIGRATIONS])
+
+
+def getStatuses(blog):
+    """ each migration along with how far it has got for a blog, or None if it has never run """
+    statuses = ndb.get_multi([ndb.Key(BlogMigration, migration.name, parent=blog.key) for migration in MIGRATIONS])
+    return zip(MIGRATIONS, statuses)
+
+def start(blog, names):
+    """ queues up the named migrations to run one after the other """
+    names = [migration.name for migration in MIGRATIONS if migration.name in names]
+    if not names:
+        return
+
+    def txn():
+        statuses = ndb.get_multi([ndb.Key(BlogMigration, name, parent=blog.key) for name in names])
+        ndb.put_multi([BlogMigration(id=name, step=status and status.step + 1 or 0, parent=blog.key)
+            for name, status in zip(names, statuses)])
+        first = statuses[0]
+        deferred.defer(run, blog.slug, names, first and first.step + 1 or 0, _transactional=True)
+
+    ndb.transaction(txn)
+
+def run(slug, names, step):
+    """ runs one batch of the first migration, then defers the next batch or the next migration """
+    blog_key = ndb.Key(model.Blog, slug)
+    migration = BY_NAME[names[0]]
+    status = BlogMigration.get_by_id(migration.name, parent=blog_key)
+    blog = blog_key.get()
+    if not blog or not status or status.step != step or status.state == DONE:
+        # this batch has already run, or the migration was started again
+        return
+
+    if status.state == QUEUED:
+        migration.start(blog)
+
+    def txn():
+        current = status.key.get()
+        if current.step != step:
+            return None
+        # everything is in the blog's entity group, so the batch can be read fresh each time this is tried
+        cursor = current.cursor and Cursor(urlsafe=current.cursor) or None
+        entities, next_cursor, more = migration.query(blog).fetch_page(migration.batch, start_cursor=cursor)
+        migration.migrate(blog, entities)
+        current.state = RUNNING
+        current.processed += len(entities)
+        current.cursor = more and next_cursor and next_cursor.urlsafe() or None
+        current.step += 1
+        if current.cursor:
+            deferred.defer(run, slug, names, current.step, _transactional=True)
+        else:
+            current.state = DONE
+            if len(names) > 1:
+                following = BlogMigration.get_by_id(names[1], parent=blog_key)
+                deferred.defer(run, slug, names[1:], following.step, _transactional=True)
+        current.put()
+        return current
+
+    current = ndb.transaction(txn)
+
+    if current and current.state == DONE and len(names) == 1:
+        # pages might show anything that was changed
+        cache.bumpGenerations(slug, [cache.BLOG])
@@ -1,9 +1,17 @@
 
+import math
 import re
+from hashlib import sha1
+from calendar import timegm
 from time import mktime
 from datetime import datetime
 
-from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred, ndb
+
+from gae_blog.config import SEARCH_SHARDS, SEARCH_QUEUE, RENAME_BATCH
+from gae_blog import search
+from gae_blog.blocklist import Blocklist
 
 
 # standard model objects
@@ -14,6 +22,7 @@ class Blog(ndb.Model):
     enable_comments = ndb.BooleanProperty(default=False)
     enable_linkbacks = ndb.BooleanProperty(default=False)
     moderation_alert = ndb.BooleanProperty(default=False)
+    digest_interval = ndb.IntegerProperty(default=0) # minutes to collect moderation alerts for, 0 sends each one on its own
     contact = ndb.BooleanProperty(default=False)
     author_pages = ndb.BooleanProperty(default=False)
     admin_email = ndb.StringProperty()
@@ -22,11 +31,31 @@ class Blog(ndb.Model):
     template = ndb.StringProperty()
     mail_queue = ndb.StringProperty(default="mail")
     blocklist = ndb.StringProperty(repeated=True)
+    ip_write_budget = ndb.IntegerProperty(default=20) # comments, messages and linkbacks each address can send an hour, 0 for no limit
+    blog_write_budget = ndb.IntegerProperty(default=1000) # the same for everyone together
+    summaries = ndb.BooleanProperty(default=False) # list posts by their excerpts instead of their full bodies
+    # when the next scheduled post goes live, NEVER if none are scheduled, or None if it hasn't been worked out yet
+    next_publish = ndb.DateTimeProperty(indexed=False)
 
     @property
     def slug(self):
         return self.key.string_id()
 
+    @property
+    def publish_cutoff(self):
+        """ posts from before this are live, and it stays the same until the next scheduled post goes live
+            so that queries using it are the same from one request to the next, unlike ones using the current time """
+        return self.next_publish or datetime.utcnow()
+
+    def blocks(self, ip_address):
+        """ if an address is covered by the blocklist, which is only compiled once for each copy of the blog """
+        entries = self.blocklist
+        compiled = getattr(self, "_blocklist", None)
+        if not compiled or compiled[0] is not entries or compiled[1] != len(entries):
+            compiled = (entries, len(entries), Blocklist(entries))
+            self._blocklist = compiled
+        return ip_address in compiled[2]
+
     @property
     def posts(self):
         return BlogPost.query(ancestor=self.key)
@@ -43,6 +72,10 @@ class Blog(ndb.Model):
     def images(self):
         return BlogImage.query(ancestor=self.key)
 
+    @property
+    def cards(self):
+        return BlogPostCard.query(ancestor=self.key)
+
     @property
     def children(self):
         # comments are grand children, not direct children, so they are not included here
@@ -50,7 +83,11 @@ class Blog(ndb.Model):
 
     @property
     def published_posts(self):
-        return self.posts.filter(BlogPost.published == True).filter(BlogPost.timestamp < datetime.utcnow()).order(-BlogPost.timestamp)
+        return publishedPosts(self, cutoff=self.publish_cutoff)
+
+    @property
+    def published_count(self):
+        return getCount(self.key, PUBLISHED_POSTS)
 
 
 class BlogAuthor(ndb.Model):
@@ -76,8 +113,8 @@ class BlogAuthor(ndb.Model):
         return BlogPost.query(BlogPost.author == self.key)
 
     @property
-    def published_posts(self):
-        return self.posts.filter(BlogPost.published == True).filter(BlogPost.timestamp < datetime.utcnow()).order(-BlogPost.timestamp)
+    def published_count(self):
+        return getCount(self.key, PUBLISHED_POSTS)
 
 
 class BlogTag(ndb.Model):
@@ -97,41 +134,84 @@ class BlogTag(ndb.Model):
         return BlogPost.query(BlogPost.tag_keys == self.key)
 
     @property
-    def published_posts(self):
-        return self.posts.filter(BlogPost.published == True).filter(BlogPost.timestamp < datetime.utcnow()).order(-BlogPost.timestamp)
+    def published_count(self):
+        return getCount(self.key, PUBLISHED_POSTS)
 
 
-class BlogPost(ndb.Model):
-
-    title = ndb.StringProperty(required=True) # max of 500 chars
-    body = ndb.TextProperty() # returns type db.Text (a subclass of unicode)
-    published = ndb.BooleanProperty(default=False)
-    timestamp = ndb.DateTimeProperty(auto_now_add=True)
-    author = ndb.KeyProperty(kind=BlogAuthor, required=True)
-    tag_keys = ndb.KeyProperty(kind=BlogTag, repeated=True)
+class PostDisplay(object):
+    """ what's needed to display a post in a list, shared by posts and their cards """
 
     @property
     def slug(self):
         return self.key.string_id()
 
     @property
-    def blog(self):
-        return self.key.parent().get()
+    def post_key(self):
+        return ndb.Key(BlogPost, self.key.string_id(), parent=self.key.parent())
+
+    @property
+    def author_entity(self):
+        if hasattr(self, "_prefetched"):
+            return self._prefetched["author"]
+        return self.author.get()
 
     @property
     def tags(self):
+        if hasattr(self, "_prefetched"):
+            return self._prefetched["tags"]
         return ndb.get_multi(self.tag_keys)
 
     @property
     def tag_names(self):
         return [tag.name for tag in self.tags]
 
+    @property
+    def secondsSinceEpoch(self):
+        return mktime(self.timestamp.timetuple())
+
+    def comment_count(self, blog):
+        names = []
+        if blog.enable_comments:
+            names.append(COMMENTS)
+        if blog.enable_linkbacks:
+            names.append(LINKBACKS)
+        if hasattr(self, "_prefetched"):
+            return sum([self._prefetched[name] for name in names])
+        return sum(getCounts([(self.post_key, name) for name in names]))
+
+
+class BlogPost(PostDisplay, ndb.Model):
+
+    title = ndb.StringProperty(required=True) # max of 500 chars
+    body = ndb.TextProperty() # returns type db.Text (a subclass of unicode)
+    published = ndb.BooleanProperty(default=False)
+    timestamp = ndb.DateTimeProperty(auto_now_add=True)
+    author = ndb.KeyProperty(kind=BlogAuthor, required=True)
+    tag_keys = ndb.KeyProperty(kind=BlogTag, repeated=True)
+    counted = ndb.BooleanProperty(default=False, indexed=False) # included in the published counts
+    # these are worked out from the body when it's saved so that reading them never needs the full body
+    excerpt = ndb.TextProperty() # plain text
+    word_count = ndb.IntegerProperty(indexed=False)
+    reading_time = ndb.IntegerProperty(indexed=False) # minutes
+
+    @property
+    def blog(self):
+        return self.key.parent().get()
+
+    @property
+    def card(self):
+        return BlogPostCard(id=self.slug, parent=self.key.parent(), title=self.title, published=self.published,
+            timestamp=self.timestamp, author=self.author, tag_keys=self.tag_keys, excerpt=self.excerpt,
+            word_count=self.word_count, reading_time=self.reading_time)
+
     @property
     def comments(self):
         return BlogComment.query(ancestor=self.key)
 
     @property
     def approved_comments(self):
+        if hasattr(self, "_prefetched") and "approved_comments" in self._prefetched:
+            return self._prefetched["approved_comments"]
         return self.comments.filter(BlogComment.approved == True).order(BlogComment.timestamp)
 
     @property
@@ -147,8 +227,13 @@ class BlogPost(ndb.Model):
         return self.comments
 
     @property
-    def secondsSinceEpoch(self):
-        return mktime(self.timestamp.timetuple())
+    def live(self):
+        return self.published and (self.timestamp is None or self.timestamp <= datetime.utcnow())
+
+    @property
+    def counted_keys(self):
+        # everything whose published count includes this post
+        return [self.key.parent(), self.author] + self.tag_keys
 
     def summarize(self, length):
         # returns a copy of the body truncated to the specified number of words
@@ -159,6 +244,16 @@ class BlogPost(ndb.Model):
         else:
             return " ".join(words[:length]) + "..."
 
+    def updateSummary(self):
+        no_html = stripHTML(self.body or "")
+        words = no_html.split()
+        self.word_count = len(words)
+        self.reading_time = int(math.ceil(len(words) / float(WORDS_PER_MINUTE)))
+        if len(words) <= EXCERPT_LENGTH:
+            self.excerpt = " ".join(words)
+        else:
+            self.excerpt = " ".join(words[:EXCERPT_LENGTH]) + "..."
+
     def enabled_comments(self, blog):
         comments = []
         if blog.enable_comments and blog.enable_linkbacks:
@@ -170,6 +265,19 @@ class BlogPost(ndb.Model):
         return comments
 
 
+class BlogPostCard(PostDisplay, ndb.Model):
+    """ a copy of everything about a post except its body, saved along with it so that lists of posts stay small """
+
+    title = ndb.StringProperty(required=True)
+    published = ndb.BooleanProperty(default=False)
+    timestamp = ndb.DateTimeProperty()
+    author = ndb.KeyProperty(kind=BlogAuthor, required=True)
+    tag_keys = ndb.KeyProperty(kind=BlogTag, repeated=True)
+    excerpt = ndb.TextProperty()
+    word_count = ndb.IntegerProperty(indexed=False)
+    reading_time = ndb.IntegerProperty(indexed=False)
+
+
 class BlogComment(ndb.Model):
 
     name = ndb.StringProperty()
@@ -184,6 +292,7 @@ class BlogComment(ndb.Model):
     timestamp = ndb.DateTimeProperty(auto_now_add=True)
     ip_address = ndb.StringProperty(default='')
     author = ndb.KeyProperty(kind=BlogAuthor)
+    counted = ndb.BooleanProperty(default=False, indexed=False) # included in the post's comment counts
 
     @property
     def post(self):
@@ -197,6 +306,21 @@ class BlogComment(ndb.Model):
     def linkback(self):
         return self.trackback or self.pingback or self.webmention
 
+    @property
+    def linkback_type(self):
+        for name in ("trackback", "pingback", "webmention"):
+            if getattr(self, name):
+                return name
+
+    @property
+    def counter_name(self):
+        return self.linkback and LINKBACKS or COMMENTS
+
+    @property
+    def receipt_key(self):
+        if self.linkback and self.url:
+            return linkbackReceiptKey(self.key.parent(), self.linkback_type, self.url)
+
 
 class BlogImage(ndb.Model):
 
@@ -209,7 +333,95 @@ class BlogImage(ndb.Model):
         return self.key.parent().get()
 
 
+class BlogCounter(ndb.Model):
+    """ a denormalized count stored as a child of whatever it counts, keyed by the name of what's counted
+        everything counted lives in the blog's entity group, so a single entity per count is enough """
+
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class BlogLinkbackReceipt(ndb.Model):
+    """ marks that a post has a linkback of one type from one source, so that a duplicate can be found with a get
+        it's a child of the post keyed by a hash of the type and source, which makes saving one idempotent """
+
+    url = ndb.StringProperty(indexed=False)
+    timestamp = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class BlogSearchShard(ndb.Model):
+    """ the postings of one search term for the posts that fall in one shard, keyed by the term and shard """
+
+    postings = ndb.JsonProperty(compressed=True) # slug => [occurrences, word count, seconds since epoch]
+
+
+class BlogSearchPost(ndb.Model):
+    """ the terms a post was last indexed under, keyed by its slug, so that they can be taken out when it changes """
+
+    terms = ndb.StringProperty(repeated=True, indexed=False)
+
+
+# blog rename states
+COPYING = "copying"
+DELETING = "deleting"
+RENAMED = "renamed"
+
+
+class BlogRename(ndb.Model):
+    """ the progress of moving a blog and everything in it to a new slug, keyed by the old slug
+        each batch is saved along with this, so a failed task carries on from the last one that finished """
+
+    new_slug = ndb.StringProperty(required=True)
+    state = ndb.StringProperty(default=COPYING) # then DELETING once the new blog has taken over, and RENAMED
+    cursor = ndb.StringProperty(indexed=False)
+    step = ndb.IntegerProperty(default=0, indexed=False) # stops a task that ran twice from doing its batch twice
+    copied = ndb.IntegerProperty(default=0, indexed=False)
+    deleted = ndb.IntegerProperty(default=0, indexed=False)
+    timestamp = ndb.DateTimeProperty(auto_now_add=True)
+
+    @property
+    def old_slug(self):
+        return self.key.string_id()
+
+    @property
+    def finished(self):
+        return self.state == RENAMED
+
+
+# post summaries
+EXCERPT_LENGTH = 50 # words
+WORDS_PER_MINUTE = 200
+
+# counter names
+PUBLISHED_POSTS = "published_posts"
+COMMENTS = "comments"
+LINKBACKS = "linkbacks"
+
+# comments saved or deleted in each transaction, which can only write so many entities
+COMMENT_BATCH = 100
+
+# a blog's publish cutoff while it has no scheduled posts
+NEVER = datetime(9999, 12, 31)
+
+
 # misc functions
+def publishedPosts(entity, model_class=BlogPost, ascending=False, cutoff=None):
+    """ a query for the published posts of a blog, author, or tag (or just its key), or for their cards
+        pass the blog's `publish_cutoff` to find the live posts with a query that can be cached """
+    key = isinstance(entity, ndb.Key) and entity or entity.key
+    kind = key.kind()
+    if kind == "BlogAuthor":
+        query = model_class.query(model_class.author == key)
+    elif kind == "BlogTag":
+        query = model_class.query(model_class.tag_keys == key)
+    else:
+        query = model_class.query(ancestor=key)
+
+    query = query.filter(model_class.published == True).filter(model_class.timestamp < (cutoff or datetime.utcnow()))
+
+    if ascending:
+        return query.order(model_class.timestamp)
+    return query.order(-model_class.timestamp)
+
 def stripHTML(string):
     # remove style or script tags first, and that includes anything inside them
     some_html = re.sub(r'(<style>.*</style>)*(<script>.*</script>)*', '', string)
@@ -237,12 +449,37 @@ def makeNew(model_object, id=None, parent=None, use_transaction=True):
         d = model_object.to_dict()
         # list forces execution, which we need since we're about to delete this
         children = hasattr(model_object, "children") and list(model_object.children) or []
+        # counters belong to what they count, so they move with it, as do a post's linkback receipts
+        counters = []
+        if model_object.key.kind() in ("Blog", "BlogAuthor", "BlogTag", "BlogPost"):
+            counters = [counter for counter in BlogCounter.query(ancestor=model_object.key)
+                if counter.key.parent() == model_object.key]
+        receipts = []
+        if model_object.key.kind() == "BlogPost":
+            receipts = BlogLinkbackReceipt.query(ancestor=model_object.key).fetch()
         # delete current (must come first so that the key name can be made the same if necessary)
         model_object.key.delete()
         # make new
         new_object = model_object.__class__(id=id, parent=parent, **d)
         new_object.put()
 
+        if counters:
+            ndb.delete_multi([counter.key for counter in counters])
+            ndb.put_multi([BlogCounter(id=counter.key.string_id(), count=counter.count, parent=new_object.key)
+                for counter in counters])
+
+        if receipts:
+            ndb.delete_multi([receipt.key for receipt in receipts])
+            ndb.put_multi([BlogLinkbackReceipt(id=receipt.key.string_id(), parent=new_object.key, **receipt.to_dict())
+                for receipt in receipts])
+
+        # and a post's card is replaced by one with the new key, as is its place in the search index
+        if model_object.key.kind() == "BlogPost":
+            ndb.Key(BlogPostCard, model_object.key.string_id(), parent=model_object.key.parent()).delete()
+            new_object.card.put()
+            for post_key in [model_object.key, new_object.key]:
+                deferred.defer(indexPost, post_key, _queue=SEARCH_QUEUE, _transactional=ndb.in_transaction())
+
         # replace the parent on all the children
         # NOTE that nested transactions aren't supported, so these must use_transaction=False
         for child in children:
@@ -258,6 +495,536 @@ def makeNew(model_object, id=None, parent=None, use_transaction=True):
 
     return new_object
 
+def rekey(key, old_root, new_root):
+    # the same key with a different root, for anything in the old blog
+    if key and key.root() == old_root:
+        return ndb.Key(pairs=new_root.pairs() + key.pairs()[1:])
+    return key
+
+def copyEntity(entity, old_root, new_root):
+    """ a copy of an entity under a new root, with any keys it refers to within the old root moved there as well """
+    values = entity.to_dict()
+    for name, value in values.items():
+        if isinstance(value, ndb.Key):
+            values[name] = rekey(value, old_root, new_root)
+        elif isinstance(value, list):
+            values[name] = [isinstance(item, ndb.Key) and rekey(item, old_root, new_root) or item for item in value]
+    return entity.__class__(key=rekey(entity.key, old_root, new_root), **values)
+
+def renamingTo(slug):
+    """ any unfinished rename that's moving a blog to this slug """
+    for rename in BlogRename.query(BlogRename.new_slug == slug):
+        if not rename.finished:
+            return rename
+
+def startRename(blog, new_slug, task):
+    """ begins moving a blog to a new slug, a batch at a time, by deferring task(old slug, step) for each batch """
+    def txn():
+        rename = BlogRename(id=blog.slug, new_slug=new_slug)
+        rename.put()
+        deferred.defer(task, blog.slug, rename.step, _transactional=True)
+        return rename
+
+    return ndb.transaction(txn, xg=True)
+
+def renameStep(old_slug, step, task):
+    """ does one batch of a rename, deferring task(old slug, step) for the next batch until it's finished
+        the children are copied first while the old blog is still used, then the new blog replaces the old one in the
+        same transaction as the last batch, and finally the old children are deleted
+        returns the rename, or None if this step already ran """
+    rename = BlogRename.get_by_id(old_slug)
+    if not rename or rename.step != step or rename.finished:
+        return None
+
+    old_key = ndb.Key(Blog, old_slug)
+    new_key = ndb.Key(Blog, rename.new_slug)
+    puts = []
+    deletes = []
+    swap = False
+
+    if rename.state == COPYING:
+        cursor = rename.cursor and Cursor(urlsafe=rename.cursor) or None
+        # an ancestor query without a kind returns everything in the blog, in key order
+        entities, next_cursor, more = ndb.Query(ancestor=old_key).fetch_page(RENAME_BATCH, start_cursor=cursor)
+        puts = [copyEntity(entity, old_key, new_key) for entity in entities if entity.key != old_key]
+        rename.copied += len(puts)
+        rename.cursor = more and next_cursor and next_cursor.urlsafe() or None
+        if not rename.cursor:
+            rename.state = DELETING
+            swap = True
+    else:
+        deletes = ndb.Query(ancestor=old_key).fetch(RENAME_BATCH, keys_only=True)
+        rename.deleted += len(deletes)
+        if len(deletes) < RENAME_BATCH:
+            rename.state = RENAMED
+
+    rename.step += 1
+
+    def txn():
+        entities = puts + [rename]
+        keys = list(deletes)
+        if swap:
+            # the new blog replaces the old one now that everything else is in place
+            blog = old_key.get()
+            if blog:
+                entities.append(copyEntity(blog, old_key, new_key))
+                keys.append(old_key)
+        ndb.put_multi(entities)
+        ndb.delete_multi(keys)
+        if not rename.finished:
+            deferred.defer(task, old_slug, rename.step, _transactional=True)
+
+    ndb.transaction(txn, xg=True)
+    return rename
+
+@ndb.tasklet
+def getCountsAsync(pairs):
+    """ looks up the counts for a list of (counted key, name) pairs in a single batch """
+    counters = yield ndb.get_multi_async([ndb.Key(BlogCounter, name, parent=key) for key, name in pairs])
+    counts = [counter and counter.count or 0 for counter in counters]
+
+    # blogs saved by older versions don't have published counts until the migrations are run, so they're counted
+    missing = [i for i, (pair, counter) in enumerate(zip(pairs, counters)) if not counter and pair[1] == PUBLISHED_POSTS]
+    if missing:
+        queried = yield [publishedPosts(pairs[i][0]).count_async() for i in missing]
+        for i, count in zip(missing, queried):
+            counts[i] = count
+    missing = [i for i, (pair, counter) in enumerate(zip(pairs, counters)) if not counter and pair[1] in (COMMENTS, LINKBACKS)]
+    if missing:
+        queried = yield countCommentsAsync([pairs[i] for i in missing])
+        for i, count in zip(missing, queried):
+            counts[i] = count
+    raise ndb.Return(counts)
+
+@ndb.tasklet
+def countCommentsAsync(pairs):
+    """ counts the approved comments for a list of (post key, comment counter name) pairs that have no counter yet
+        and saves the counts, so they're only queried once for posts saved before the comment counts existed
+        all the posts must be from the same blog, and the counts aren't saved while its comment counts migration
+        is waiting to run or running, since that counts them all again """
+    # migrations imports this module, so it can't be imported until it's needed
+    from gae_blog import migrations
+    blog_key = pairs[0][0].parent()
+    counter_keys = [ndb.Key(BlogCounter, name, parent=key) for key, name in pairs]
+
+    @ndb.tasklet
+    def txn():
+        migration_key = ndb.Key(migrations.BlogMigration, migrations.CommentCounts.name, parent=blog_key)
+        migration, counters = yield migration_key.get_async(), ndb.get_multi_async(counter_keys)
+        post_keys = list(set([key for (key, name), counter in zip(pairs, counters) if not counter]))
+        results = yield [BlogComment.query(ancestor=key).fetch_async() for key in post_keys]
+
+        counts = dict([(pair, counter and counter.count or 0) for pair, counter in zip(pairs, counters)])
+        missing = set([pair for pair, counter in zip(pairs, counters) if not counter])
+        changed = []
+        for comments in results:
+            for comment in comments:
+                pair = (comment.key.parent(), comment.counter_name)
+                if pair not in missing:
+                    continue
+                if comment.approved:
+                    counts[pair] += 1
+                if comment.counted != comment.approved:
+                    comment.counted = comment.approved
+                    changed.append(comment)
+
+        # too many comments to save in one transaction are left for the migration to count
+        if (not migration or migration.state == migrations.DONE) and len(changed) <= COMMENT_BATCH:
+            new_counters = [BlogCounter(key=key, count=counts[pair]) for key, pair in zip(counter_keys, pairs)
+                if pair in missing]
+            yield ndb.put_multi_async(new_counters + changed)
+        raise ndb.Return([counts[pair] for pair in pairs])
+
+    counts = yield ndb.transaction_async(txn)
+    raise ndb.Return(counts)
+
+def getCounts(pairs):
+    return getCountsAsync(pairs).get_result()
+
+@ndb.tasklet
+def getCountAsync(key, name):
+    counts = yield getCountsAsync([(key, name)])
+    raise ndb.Return(counts[0])
+
+def getCount(key, name):
+    return getCountAsync(key, name).get_result()
+
+def publishedCacheTime(blog):
+    """ the memcache time for results found using the blog's publish cutoff, which expire when it passes
+        returns None if there's no cutoff yet, so they can't be cached """
+    if not blog.next_publish:
+        return None
+    if blog.next_publish >= NEVER:
+        return 0
+    # times this far ahead are taken as when to expire rather than how long to wait
+    return timegm(blog.next_publish.utctimetuple())
+
+@ndb.tasklet
+def getCardsAsync(post_keys):
+    """ looks up the cards of posts by their keys, using the full post for any saved before it had a card
+        and working out its summary if it doesn't have one of those either """
+    cards = yield ndb.get_multi_async([ndb.Key(BlogPostCard, key.string_id(), parent=key.parent()) for key in post_keys])
+    missing = [key for key, card in zip(post_keys, cards) if not card]
+    if missing:
+        posts = yield ndb.get_multi_async(missing)
+        found = dict(zip(missing, posts))
+        cards = [card or found[key] for key, card in zip(post_keys, cards)]
+        for post in posts:
+            if post and post.excerpt is None:
+                post.updateSummary()
+    raise ndb.Return([card for card in cards if card])
+
+@ndb.tasklet
+def fetchPublishedPageAsync(query, page_size, cache_key=None, cache_time=None, cards=False, **options):
+    """ fetches a page of published posts, keeping which posts were found in memcache for `cache_time`
+        the key must cover everything the results depend on, and the query must use the blog's publish cutoff
+        with `cards` only the keys of the posts are queried, and their cards are returned instead """
+    context = ndb.get_context()
+    cacheable = cache_key and cache_time is not None
+    if cacheable:
+        cached = yield context.memcache_get(cache_key)
+        if cached:
+            keys, urlsafe, more = cached
+            if cards:
+                results = yield getCardsAsync(keys)
+            else:
+                results = yield ndb.get_multi_async(keys)
+            raise ndb.Return(([result for result in results if result], urlsafe and Cursor(urlsafe=urlsafe), more))
+
+    results, cursor, more = yield query.fetch_page_async(page_size, keys_only=cards, **options)
+    keys = cards and results or [result.key for result in results]
+    if cards:
+        results = yield getCardsAsync(keys)
+    if cacheable:
+        yield context.memcache_set(cache_key, (keys, cursor and cursor.urlsafe(), more), time=cache_time)
+    raise ndb.Return((results, cursor, more))
+
+@ndb.tasklet
+def prefetchPostsAsync(posts):
+    """ resolves the authors, tags, and comment counts of a list of posts with a single batch get
+        and attaches them to each post so that rendering them doesn't need any more lookups """
+    keys = set()
+    for post in posts:
+        keys.add(post.author)
+        keys.update(post.tag_keys)
+        keys.add(ndb.Key(BlogCounter, COMMENTS, parent=post.post_key))
+        keys.add(ndb.Key(BlogCounter, LINKBACKS, parent=post.post_key))
+    keys = list(keys)
+
+    entities = yield ndb.get_multi_async(keys)
+    lookup = dict(zip(keys, entities))
+
+    missing = [(post.post_key, name) for post in posts for name in (COMMENTS, LINKBACKS)
+        if not lookup[ndb.Key(BlogCounter, name, parent=post.post_key)]]
+    counts = {}
+    if missing:
+        queried = yield countCommentsAsync(missing)
+        counts = dict(zip(missing, queried))
+
+    for post in posts:
+        comments = lookup[ndb.Key(BlogCounter, COMMENTS, parent=post.post_key)]
+        linkbacks = lookup[ndb.Key(BlogCounter, LINKBACKS, parent=post.post_key)]
+        post._prefetched = {
+            "author": lookup[post.author],
+            "tags": [lookup[key] for key in post.tag_keys],
+            COMMENTS: comments and comments.count or counts.get((post.post_key, COMMENTS), 0),
+            LINKBACKS: linkbacks and linkbacks.count or counts.get((post.post_key, LINKBACKS), 0)
+        }
+
+    raise ndb.Return(posts)
+
+def prefetchPosts(posts):
+    return prefetchPostsAsync(posts).get_result()
+
+def adjustCounts(deltas):
+    """ applies a dict of {(counted key, name): change} to the counters, creating any that don't exist yet
+        this should be called from within a transaction so that the counts stay in step with the changes """
+    keys = [ndb.Key(BlogCounter, name, parent=key) for (key, name), delta in deltas.items() if delta]
+    if keys:
+        counters = ndb.get_multi(keys)
+        new_counters = []
+        for key, counter in zip(keys, counters):
+            if not counter:
+                counter = BlogCounter(key=key)
+            counter.count = max(counter.count + deltas[(key.parent(), key.string_id())], 0)
+            new_counters.append(counter)
+        ndb.put_multi(new_counters)
+
+def countPost(post, stored, deltas, delete=False):
+    # remove whatever the stored version contributed and add what this one does
+    if stored and stored.counted:
+        for key in stored.counted_keys:
+            deltas[(key, PUBLISHED_POSTS)] = deltas.get((key, PUBLISHED_POSTS), 0) - 1
+    post.counted = not delete and post.live
+    if post.counted:
+        for key in post.counted_keys:
+            deltas[(key, PUBLISHED_POSTS)] = deltas.get((key, PUBLISHED_POSTS), 0) + 1
+
+def putPost(post):
+    """ saves a post and brings the published counts in line with it in the same transaction """
+    def txn():
+        stored = post.key.get(use_cache=False)
+        deltas = {}
+        countPost(post, stored, deltas)
+        adjustCounts(deltas)
+        ndb.put_multi([post, post.card])
+        if post.published and not post.live:
+            # count the post once it goes live
+            deferred.defer(activatePost, post.key, _eta=post.timestamp, _transactional=True)
+        deferred.defer(indexPost, post.key, _queue=SEARCH_QUEUE, _transactional=True)
+        return updateNextPublish(post.key.parent(), post)
+
+    if not post.timestamp:
+        post.timestamp = datetime.utcnow()
+    if ndb.transaction(txn):
+        bumpBlog(post.key.parent())
+    return post
+
+def activatePost(post_key):
+    post = post_key.get()
+    if post and post.live and not post.counted:
+        putPost(post)
+    elif post and post.published and not post.live:
+        # tasks can run a little early, so try again once it's really live
+        deferred.defer(activatePost, post_key, _eta=post.timestamp)
+
+def deletePost(post):
+    """ deletes a post along with its comments and counters, taking it out of the published counts """
+    # there could be too many comments to delete in one transaction, so they go in batches first
+    comments = post.comments.fetch(COMMENT_BATCH)
+    while comments:
+        deleteComments(comments)
+        comments = post.comments.fetch(COMMENT_BATCH)
+
+    def txn():
+        stored = post.key.get(use_cache=False)
+        deltas = {}
+        countPost(post, stored, deltas, delete=True)
+        adjustCounts(deltas)
+        keys = ndb.Query(ancestor=post.key).fetch(keys_only=True)
+        keys.append(post.card.key)
+        ndb.delete_multi(keys)
+        deferred.defer(indexPost, post.key, _queue=SEARCH_QUEUE, _transactional=True)
+        return updateNextPublish(post.key.parent(), post, delete=True)
+
+    if ndb.transaction(txn):
+        bumpBlog(post.key.parent())
+
+def findNextPublish(blog_key, post=None, delete=False):
+    """ when the next scheduled post in a blog goes live, or NEVER if none are scheduled
+        a query in a transaction can't see what it has written, so a post being saved or deleted is passed in """
+    now = datetime.utcnow()
+    query = BlogPost.query(ancestor=blog_key).filter(BlogPost.published == True)
+    scheduled = query.filter(BlogPost.timestamp > now).order(BlogPost.timestamp).fetch(2)
+    times = [other.timestamp for other in scheduled if not post or other.key != post.key]
+    if post and not delete and post.published and post.timestamp > now:
+        times.append(post.timestamp)
+    return min(times or [NEVER])
+
+def updateNextPublish(blog_key, post=None, delete=False):
+    """ keeps the blog's publish cutoff up to date, from within the transaction saving or deleting a post
+        returns whether it changed, in which case the blog has to be bumped once the transaction is done """
+    blog = blog_key.get()
+    next_publish = findNextPublish(blog_key, post=post, delete=delete)
+    if blog and blog.next_publish != next_publish:
+        blog.next_publish = next_publish
+        blog.put()
+        return True
+    return False
+
+def bumpBlog(blog_key):
+    # cache imports this module, so it can't be imported until it's needed
+    from gae_blog import cache
+    cache.bumpBlogVersion(blog_key.string_id())
+
+def countComments(comments, deltas, delete=False):
+    stored_comments = ndb.get_multi([comment.key for comment in comments], use_cache=False)
+    for comment, stored in zip(comments, stored_comments):
+        pair = (comment.key.parent(), comment.counter_name)
+        if stored and stored.counted:
+            deltas[pair] = deltas.get(pair, 0) - 1
+        comment.counted = not delete and comment.approved
+        if comment.counted:
+            deltas[pair] = deltas.get(pair, 0) + 1
+
+def putComments(comments):
+    """ saves comments, updating their posts' comment counts for any that were approved or unapproved
+        all the comments must be from the same blog, and are saved in batches small enough for a transaction """
+    def txn(batch):
+        deltas = {}
+        countComments(batch, deltas)
+        adjustCounts(deltas)
+        ndb.put_multi(batch)
+
+    for i in range(0, len(comments), COMMENT_BATCH):
+        ndb.transaction(lambda: txn(comments[i:i + COMMENT_BATCH]))
+
+def deleteComments(comments):
+    """ deletes comments, taking any approved ones out of their posts' comment counts
+        the receipts of any linkbacks go with them, so the same source can link back again """
+    def txn(batch):
+        deltas = {}
+        countComments(batch, deltas, delete=True)
+        adjustCounts(deltas)
+        keys = [comment.key for comment in batch]
+        keys.extend([comment.receipt_key for comment in batch if comment.receipt_key])
+        ndb.delete_multi(keys)
+
+    for i in range(0, len(comments), COMMENT_BATCH):
+        ndb.transaction(lambda: txn(comments[i:i + COMMENT_BATCH]))
+
+def linkbackReceiptKey(post_key, linkback_type, url):
+    receipt_id = sha1(linkback_type + "|" + url.encode("utf-8")).hexdigest()
+    return ndb.Key(BlogLinkbackReceipt, receipt_id, parent=post_key)
+
+def putLinkback(comment):
+    """ saves a new linkback along with its receipt, unless the post already has one of the same type from its source
+        returns whether it was saved, and is safe to retry since the receipt always has the same key """
+    def txn():
+        receipt_key = comment.receipt_key
+        if receipt_key.get():
+            return False
+        # admins can add linkbacks that are already approved
+        comment.counted = comment.approved
+        if comment.counted:
+            adjustCounts({(comment.key.parent(), comment.counter_name): 1})
+        ndb.put_multi([comment, BlogLinkbackReceipt(key=receipt_key, url=comment.url)])
+        return True
+
+    return ndb.transaction(txn)
+
+def putReceipts(comments):
+    """ adds receipts for any linkbacks saved before they existed """
+    receipts = [BlogLinkbackReceipt(key=comment.receipt_key, url=comment.url, timestamp=comment.timestamp)
+        for comment in comments if comment.receipt_key]
+    ndb.put_multi(receipts)
+
+def deleteCounters(blog, names):
+    """ deletes every count with one of these names in a blog, before they're recounted """
+    keys = BlogCounter.query(ancestor=blog.key).fetch(keys_only=True)
+    ndb.delete_multi([key for key in keys if key.string_id() in names])
+
+def recountPosts(posts):
+    """ adds posts to the published counts they belong in, which should have been deleted first
+        this should be called from within a transaction so that the counts stay in step with the posts """
+    deltas = {}
+    for post in posts:
+        countPost(post, None, deltas)
+        if post.published and not post.live and not post.counted:
+            deferred.defer(activatePost, post.key, _eta=post.timestamp)
+    adjustCounts(deltas)
+    ndb.put_multi(posts)
+
+def recountComments(comments):
+    """ the same for comments and their posts' comment and linkback counts """
+    deltas = {}
+    for comment in comments:
+        comment.counted = comment.approved
+        if comment.counted:
+            pair = (comment.key.parent(), comment.counter_name)
+            deltas[pair] = deltas.get(pair, 0) + 1
+    adjustCounts(deltas)
+    ndb.put_multi(comments)
+
+def recount(blog):
+    """ rebuilds every count for a blog from scratch, for data saved before the counts existed """
+    deleteCounters(blog, [PUBLISHED_POSTS, COMMENTS, LINKBACKS])
+    recountPosts(list(blog.posts))
+    recountComments(list(blog.comments))
+
+def searchPostings(post):
+    """ the terms of a published post mapped to its posting for each of them """
+    if not post or not post.published:
+        return {}
+    counts = search.termCounts(post.title + " " + stripHTML(post.body or ""))
+    length = sum(counts.values())
+    timestamp = int(post.secondsSinceEpoch)
+    return dict([(term, [count, length, timestamp]) for term, count in counts.items()])
+
+def indexPost(post_key):
+    """ brings the search index up to date with a post, which takes it out if it's been unpublished or deleted
+        this runs on the search queue one at a time, and is safe to repeat if it fails part way through """
+    blog_key = post_key.parent()
+    slug = post_key.string_id()
+    shard = search.shardFor(slug)
+    record_key = ndb.Key(BlogSearchPost, slug, parent=blog_key)
+
+    post, record = ndb.get_multi([post_key, record_key], use_cache=False)
+    postings = searchPostings(post)
+
+    # the record is saved last so that a retry still knows about the terms it had before
+    terms = list(set(record and record.terms or []) | set(postings))
+    shard_keys = [ndb.Key(BlogSearchShard, search.shardId(term, shard), parent=blog_key) for term in terms]
+    shards = ndb.get_multi(shard_keys, use_cache=False)
+
+    changed = []
+    emptied = []
+    for term, key, entity in zip(terms, shard_keys, shards):
+        term_postings = entity and entity.postings or {}
+        if term in postings:
+            term_postings[slug] = postings[term]
+        else:
+            term_postings.pop(slug, None)
+        if term_postings:
+            changed.append(BlogSearchShard(key=key, postings=term_postings))
+        elif entity:
+            emptied.append(key)
+
+    ndb.put_multi(changed)
+    ndb.delete_multi(emptied)
+    if postings:
+        BlogSearchPost(key=record_key, terms=postings.keys()).put()
+    elif record:
+        record_key.delete()
+
+def clearIndex(blog):
+    ndb.delete_multi(BlogSearchShard.query(ancestor=blog.key).fetch(keys_only=True) +
+        BlogSearchPost.query(ancestor=blog.key).fetch(keys_only=True))
+
+def reindex(blog):
+    """ rebuilds the search index for a blog from scratch, for posts saved before it existed """
+    clearIndex(blog)
+
+    shards = {}
+    records = []
+    for post in blog.posts:
+        postings = searchPostings(post)
+        if postings:
+            shard = search.shardFor(post.slug)
+            for term, posting in postings.items():
+                shards.setdefault(search.shardId(term, shard), {})[post.slug] = posting
+            records.append(BlogSearchPost(id=post.slug, terms=postings.keys(), parent=blog.key))
+
+    ndb.put_multi([BlogSearchShard(id=shard_id, postings=postings, parent=blog.key)
+        for shard_id, postings in shards.items()] + records)
+
+@ndb.tasklet
+def searchPostsAsync(blog, query, page, page_size):
+    """ finds the live posts that contain every term of the query, best matches first
+        returns the total number found and the prefetched cards for the page, in a bounded number of reads """
+    terms = search.queryTerms(query)
+    if not terms:
+        raise ndb.Return((0, []))
+
+    shard_keys = [ndb.Key(BlogSearchShard, search.shardId(term, shard), parent=blog.key)
+        for term in terms for shard in range(SEARCH_SHARDS)]
+    shards, total = yield ndb.get_multi_async(shard_keys), getCountAsync(blog.key, PUBLISHED_POSTS)
+
+    postings = dict([(term, {}) for term in terms])
+    for key, entity in zip(shard_keys, shards):
+        if entity:
+            term = key.string_id().rsplit("|", 1)[0]
+            postings[term].update(entity.postings)
+
+    slugs = search.rank(postings, total, mktime(datetime.utcnow().timetuple()))
+    page_slugs = slugs[page * page_size:(page + 1) * page_size]
+    cards = yield getCardsAsync([ndb.Key(BlogPost, slug, parent=blog.key) for slug in page_slugs])
+    yield prefetchPostsAsync(cards)
+    raise ndb.Return((len(slugs), cards))
+
+def searchPosts(blog, query, page=0, page_size=10):
+    return searchPostsAsync(blog, query, page, page_size).get_result()
+
 def slugify(name):
     slug = name.lower().replace(" ", "-").replace("/", "-").encode("utf-8")
     slug = ''.join([char for char in slug if char.isalnum() or char == '-'])
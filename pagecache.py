@@ -0,0 +1,208 @@
+# the page cache used when gae_html isn't installed, with tiers in each instance's memory, memcache and the datastore
+# every copy of a page is saved with the generations it was rendered with, so it's only served while they're current
+# to stop a burst of requests all rendering the same page, only the one holding a lease renders it while the rest
+# serve the last copy, and pages are rendered again a little before they expire on their own
+# with PAGE_REVALIDATE on, the lease holder serves the last copy too and leaves the rendering to a task
+
+import json
+import math
+import os
+import random
+import time
+from hashlib import sha1
+
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import deferred, ndb
+
+import webapp2
+
+from gae_blog.config import (PAGE_CACHE_SIZE, PAGE_CACHE_TTL, PAGE_CACHE_BETA, PAGE_LEASE_TIME, PAGE_LEASE_WAIT,
+    PAGE_REVALIDATE, BLOG_APP)
+from gae_blog.cache import LRUCache
+
+PAGE_KEY = "GAE_BLOG_PAGE"
+LEASE_KEY = "GAE_BLOG_PAGE_LEASE"
+WAIT_INTERVAL = 0.1
+# set on the requests made by tasks, which always render the page
+RENDER_ENVIRON = "gae_blog.render"
+
+# page key => (generations, content type, body, time saved, seconds it took to render)
+pages = LRUCache(PAGE_CACHE_SIZE)
+
+
+class HTMLCache(ndb.Model):
+    """ a page saved for when it's been evicted from memcache, the same kind gae_html uses for this """
+
+    generations = ndb.JsonProperty(indexed=False)
+    content_type = ndb.StringProperty(indexed=False)
+    body = ndb.BlobProperty(compressed=True)
+    saved = ndb.FloatProperty(indexed=False, default=0)
+    delta = ndb.FloatProperty(indexed=False, default=0)
+
+
+def datastoreKey(key):
+    # key names are limited in length, so long query strings are hashed
+    if len(key) > 400:
+        key = sha1(key).hexdigest()
+    return ndb.Key(HTMLCache, key)
+
+
+def getEntry(key, generations, use_datastore=False):
+    """ the copy of a page from the fastest tier that has one rendered with these generations
+        if none of them do the newest out of date copy is returned instead, or None if there isn't one """
+    entries = []
+    entry = pages.get(key)
+    if entry:
+        if entry[0] == generations:
+            return entry
+        # an out of date copy is only served from the shared tiers, which are cleared if the page has gone
+        pages.delete(key)
+
+    entry = memcache.get(PAGE_KEY + "|" + key)
+    if entry:
+        if entry[0] == generations:
+            pages.set(key, entry)
+            return entry
+        entries.append(entry)
+
+    if use_datastore:
+        stored = datastoreKey(key).get()
+        if stored:
+            entry = (stored.generations, stored.content_type, stored.body, stored.saved, stored.delta)
+            if entry[0] == generations:
+                memcache.set(PAGE_KEY + "|" + key, entry)
+                pages.set(key, entry)
+                return entry
+            entries.append(entry)
+
+    if entries:
+        return max(entries, key=lambda entry: entry[3])
+
+
+def savePage(key, generations, content_type, body, delta=0, use_datastore=False):
+    saved = time.time()
+    entry = (generations, content_type, body, saved, delta)
+    pages.set(key, entry)
+    memcache.set(PAGE_KEY + "|" + key, entry)
+    if use_datastore:
+        HTMLCache(key=datastoreKey(key), generations=generations, content_type=content_type, body=body,
+            saved=saved, delta=delta).put()
+
+
+def deletePage(key, use_datastore=False):
+    pages.delete(key)
+    memcache.delete(PAGE_KEY + "|" + key)
+    if use_datastore:
+        datastoreKey(key).delete()
+
+
+def expiring(entry, now=None):
+    """ whether a copy should be rendered again, which gets more likely the closer it is to expiring
+        and the longer it took to render, so that one request usually does it before the rest all would """
+    saved, delta = entry[3], entry[4]
+    now = now or time.time()
+    # 1 - random() is never 0, which log can't take
+    return now - delta * PAGE_CACHE_BETA * math.log(1 - random.random()) >= saved + PAGE_CACHE_TTL
+
+
+def leased(key):
+    """ takes the lease on rendering a page, returning False if another request already has it """
+    lease_key = LEASE_KEY + "|" + key
+    if memcache.add(lease_key, 1, time=PAGE_LEASE_TIME):
+        return True
+    # adding also fails when memcache can't be reached, so only give way to a lease that really exists
+    return memcache.get(lease_key) is None
+
+
+def waitForPage(key, generations):
+    """ waits for the request holding the lease to save the page, returning None if it doesn't in time """
+    waited = 0
+    while waited < PAGE_LEASE_WAIT:
+        time.sleep(WAIT_INTERVAL)
+        waited += WAIT_INTERVAL
+        entry = memcache.get(PAGE_KEY + "|" + key)
+        if entry and entry[0] == generations:
+            pages.set(key, entry)
+            return entry
+
+
+def queueRender(request, key, entry):
+    """ renders the page again in a task, which releases the lease once it's saved """
+    # each copy is only replaced once for each lease, however many times this is called for it
+    # but once the lease has run out another task can be queued, in case this one didn't manage it
+    bucket = int(time.time() / PAGE_LEASE_TIME)
+    name = "render-" + sha1("|".join([key, json.dumps(entry[0], sort_keys=True), repr(entry[3]),
+        str(bucket)])).hexdigest()
+    try:
+        deferred.defer(renderPage, request.host_url, request.host, request.path_qs, _name=name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def renderPage(host_url, host, path):
+    """ requests the page within this instance, as someone who isn't logged in would """
+    # imported here since the app imports the controllers that import this
+    app = webapp2.import_string(BLOG_APP)
+    # the host is given as it was so that the page is saved under the same key
+    app.get_response(path, base_url=host_url, environ={RENDER_ENVIRON: True, "HTTP_HOST": host})
+
+
+def servePage(controller, entry, generations):
+    if entry[0] != generations:
+        # the validators are for the current page, so they mustn't be kept with an older one
+        controller.response.headers.pop("ETag", None)
+        controller.response.headers.pop("Last-Modified", None)
+    controller.response.headers["Content-Type"] = entry[1]
+    if controller.request.method == "GET":
+        controller.response.out.write(entry[2])
+
+
+def renderCached(controller, page_key, generations, action, args, kwargs, skip_check=None, use_datastore=False,
+        content_type=None, **options):
+    """ serves the page from the cache if it has a current copy, otherwise renders it with the action and saves it
+        nothing is minified, so HTML comments are always kept whatever `include_comments` says """
+    development = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+    # pages can look different for users, and aren't cached while developing so that changes show up straight away
+    if development or controller.user or controller.request.method not in ("GET", "HEAD") or \
+            (skip_check and skip_check(controller)):
+        return action(controller, *args, **kwargs)
+
+    # the host is included since some pages link to themselves with it
+    key = controller.request.host + page_key
+    if controller.request.environ.get(RENDER_ENVIRON):
+        # a task rendering the page for the request that took the lease
+        lease = True
+    else:
+        entry = getEntry(key, generations, use_datastore)
+        if entry and entry[0] == generations and not expiring(entry):
+            return servePage(controller, entry, generations)
+
+        # a HEAD request doesn't render the body, so it can't save the page for anyone else
+        lease = controller.request.method == "GET" and leased(key)
+        if lease and entry and PAGE_REVALIDATE:
+            queueRender(controller.request, key, entry)
+            return servePage(controller, entry, generations)
+        if not lease:
+            if not entry and controller.request.method == "GET":
+                entry = waitForPage(key, generations)
+            if entry:
+                return servePage(controller, entry, generations)
+
+    start = time.time()
+    try:
+        result = action(controller, *args, **kwargs)
+        if lease:
+            if controller.response.status_int == 200:
+                savePage(key, generations, content_type or controller.response.headers.get("Content-Type"),
+                    controller.response.body, time.time() - start, use_datastore)
+            else:
+                # the page has gone or is broken, so the last copy mustn't be served any longer
+                deletePage(key, use_datastore)
+    except Exception:
+        if lease:
+            deletePage(key, use_datastore)
+        raise
+    finally:
+        if lease:
+            memcache.delete(LEASE_KEY + "|" + key)
+    return result
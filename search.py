@@ -0,0 +1,73 @@
+# full text search of published posts, these are the parts that don't need the datastore
+
+import math
+import re
+import zlib
+
+from gae_blog.config import SEARCH_SHARDS, SEARCH_MAX_TERMS
+
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# too common to say anything about which posts match
+STOP_WORDS = frozenset(["an", "and", "are", "as", "at", "be", "but", "by", "for", "from", "has", "have", "if", "in",
+    "into", "is", "it", "its", "not", "of", "on", "or", "so", "that", "the", "their", "then", "there", "these", "they",
+    "this", "to", "was", "were", "which", "will", "with"])
+
+
+def tokenize(text):
+    """ splits plain text into lowercase terms, leaving out stop words and single characters """
+    return [word for word in WORD_RE.findall(text.lower()) if len(word) > 1 and word not in STOP_WORDS]
+
+
+def termCounts(text):
+    counts = {}
+    for term in tokenize(text):
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+
+def queryTerms(query):
+    """ the unique terms of a query in the order they were given, up to the maximum that's searched """
+    terms = []
+    for term in tokenize(query):
+        if term not in terms:
+            terms.append(term)
+    return terms[:SEARCH_MAX_TERMS]
+
+
+def shardFor(slug):
+    # this has to be the same in every process, which the builtin hash isn't guaranteed to be
+    return zlib.crc32(slug.encode("utf-8")) % SEARCH_SHARDS
+
+
+def shardId(term, shard):
+    return term + "|" + str(shard)
+
+
+def rank(postings, total, now):
+    """ orders the posts that contain every term by tf-idf, with newer posts first for equal scores
+        `postings` maps each term to a mapping of slug => [occurrences, word count, seconds since epoch]
+        `total` is the number of published posts and posts timestamped after `now` are left out """
+    if not postings:
+        return []
+
+    # start with the rarest term so that there's the least to intersect
+    terms = sorted(postings, key=lambda term: len(postings[term]))
+    slugs = set(slug for slug, posting in postings[terms[0]].iteritems() if posting[2] <= now)
+    for term in terms[1:]:
+        slugs.intersection_update(postings[term])
+        if not slugs:
+            return []
+
+    scores = dict.fromkeys(slugs, 0.0)
+    for term in terms:
+        term_postings = postings[term]
+        idf = math.log(1 + float(max(total, len(term_postings))) / len(term_postings))
+        for slug in slugs:
+            scores[slug] += term_postings[slug][0] * idf
+
+    # dividing by the square root of the length stops long posts from winning just by being long
+    first = postings[terms[0]]
+    keys = dict((slug, (-scores[slug] / math.sqrt(first[slug][1]), -first[slug][2])) for slug in slugs)
+    return sorted(slugs, key=keys.__getitem__)
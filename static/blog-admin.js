@@ -27,6 +27,17 @@ if (gaeblog.advanced_link) {
     gaeblog.advanced_link.addEventListener("click", gaeblog.handleAdvancedLink, false);
 }
 
+/* comments page */
+gaeblog.select_all_comments = document.getElementById("select-all-comments");
+if (gaeblog.select_all_comments) {
+    gaeblog.select_all_comments.addEventListener("click", function(e) {
+        var boxes = document.getElementsByClassName("select-comment");
+        for (var i=0; i < boxes.length; i++) {
+            boxes[i].checked = gaeblog.select_all_comments.checked;
+        }
+    }, false);
+}
+
 /* view post page */
 gaeblog.author_info = document.getElementById("comment-author-info");
 gaeblog.author_radio = document.getElementById("author-choice-author");
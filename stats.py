@@ -0,0 +1,163 @@
+# timing of each request and the API calls it makes, logged and sampled into memcache for the admin stats page
+
+import json
+import logging
+import math
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map, memcache
+
+from gae_blog.config import STATS_ENABLED, STATS_SAMPLES
+
+HOOK_KEY = "gae_blog_stats"
+SAMPLE_KEY = "GAE_BLOG_STATS"
+
+# the services worth showing separately, anything else is counted as other
+SERVICES = ["datastore_v3", "memcache", "taskqueue", "urlfetch", "mail", "user"]
+OTHER = "other"
+
+# the request being timed on this thread
+current = threading.local()
+
+
+class Recorder(object):
+    """ adds up where the time for one request went """
+
+    def __init__(self, path):
+        self.path = path
+        self.controller = None
+        self.started = time.time()
+        self.calls = {} # service => [count, milliseconds]
+        self.pending = {} # id of the call's response => (service, start time)
+        self.template_ms = 0.0
+
+    def startCall(self, service, response):
+        self.pending[id(response)] = (service, time.time())
+
+    def endCall(self, response):
+        service, started = self.pending.pop(id(response), (None, None))
+        if service:
+            if service not in SERVICES:
+                service = OTHER
+            totals = self.calls.setdefault(service, [0, 0.0])
+            totals[0] += 1
+            totals[1] += (time.time() - started) * 1000
+
+    def sample(self, status, size):
+        calls = dict([(service, [count, round(ms, 1)]) for service, (count, ms) in self.calls.items()])
+        return {"controller": self.controller, "path": self.path, "status": status, "size": size,
+            "ms": round((time.time() - self.started) * 1000, 1), "template_ms": round(self.template_ms, 1),
+            "calls": calls}
+
+
+def preCall(service, call, request, response, rpc=None):
+    recorder = getattr(current, "recorder", None)
+    if recorder:
+        recorder.startCall(service, response)
+
+def postCall(service, call, request, response, rpc=None, error=None):
+    recorder = getattr(current, "recorder", None)
+    if recorder:
+        recorder.endCall(response)
+
+def installHooks():
+    # the proxy can be replaced (by tests for one), and appending a hook that's already there does nothing
+    proxy = apiproxy_stub_map.apiproxy
+    proxy.GetPreCallHooks().Append(HOOK_KEY, preCall)
+    proxy.GetPostCallHooks().Append(HOOK_KEY, postCall)
+
+
+def setController(name):
+    """ called by the controller handling a request so that the request can be grouped with others like it """
+    recorder = getattr(current, "recorder", None)
+    if recorder:
+        recorder.controller = name
+
+def addTemplateTime(seconds):
+    recorder = getattr(current, "recorder", None)
+    if recorder:
+        recorder.template_ms += seconds * 1000
+
+
+class StatsMiddleware(object):
+    """ wraps the WSGI app to time each request, passing anything else through to the app """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __getattr__(self, name):
+        return getattr(self.app, name)
+
+    def __call__(self, environ, start_response):
+        if not STATS_ENABLED:
+            return self.app(environ, start_response)
+
+        installHooks()
+        recorder = current.recorder = Recorder(environ.get("PATH_INFO", ""))
+        status = []
+
+        def timedStartResponse(status_line, headers, exc_info=None):
+            status.append(int(status_line.split(" ", 1)[0]))
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            # webapp2 gives back a list, so the size can be measured without getting in the way of streaming
+            body = self.app(environ, timedStartResponse)
+            size = isinstance(body, list) and sum([len(chunk) for chunk in body]) or None
+        finally:
+            current.recorder = None
+
+        self.record(recorder.sample(status and status[0] or None, size))
+        return body
+
+    def record(self, sample):
+        logging.info("request stats %s", json.dumps(sample, sort_keys=True))
+        if not sample["controller"]:
+            return
+        try:
+            saveSample(sample)
+        except Exception:
+            # stats are never worth failing a request over
+            logging.exception("failed to save request stats")
+
+
+def saveSample(sample):
+    # memcache is used as a ring buffer of the most recent requests for each controller
+    prefix = SAMPLE_KEY + "|" + sample["controller"]
+    index = memcache.incr(prefix, initial_value=0)
+    if index is not None:
+        memcache.set(prefix + "|" + str(index % STATS_SAMPLES), sample)
+
+def getSamples(names):
+    """ the samples kept for each of the named controllers that has any, as controller name => list of samples """
+    keys = [SAMPLE_KEY + "|" + name + "|" + str(i) for name in names for i in range(STATS_SAMPLES)]
+    samples = {}
+    for sample in memcache.get_multi(keys).values():
+        samples.setdefault(sample["controller"], []).append(sample)
+    return samples
+
+
+def percentile(values, fraction):
+    """ the value that this fraction of the values are at or below, using the nearest rank """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+def summarize(samples):
+    """ percentiles of the time taken by a controller's requests, with the average calls and size for each one """
+    count = len(samples)
+    times = [sample["ms"] for sample in samples]
+    calls = {}
+    for sample in samples:
+        for service, (service_count, ms) in sample["calls"].items():
+            totals = calls.setdefault(service, [0, 0.0])
+            totals[0] += service_count
+            totals[1] += ms
+    sizes = [sample["size"] for sample in samples if sample["size"] is not None]
+    return {"count": count, "p50": percentile(times, 0.5), "p90": percentile(times, 0.9),
+        "p99": percentile(times, 0.99), "template_ms": sum([sample["template_ms"] for sample in samples]) / count,
+        "size": sizes and sum(sizes) / len(sizes) or 0,
+        "calls": dict([(service, (float(total) / count, ms / count)) for service, (total, ms) in calls.items()])}
@@ -0,0 +1,44 @@
+# the jinja environment the templates are rendered with, kept apart from the controllers so they can be compiled ahead of time
+
+import os
+
+import jinja2
+
+from gae_blog.config import TEMPLATES_PATH, COMPILED_TEMPLATES_PATH, DEVELOPMENT
+
+
+class RelativeEnvironment(jinja2.Environment):
+    """ enable relative template paths """
+
+    def join_path(self, template, parent):
+        # normalized so that every way of reaching a template gives it the same name, which is what compiled ones are found by
+        return os.path.normpath(os.path.join(os.path.dirname(parent), template))
+
+
+class RelativeLoader(jinja2.BaseLoader):
+    """ enable relative template paths """
+
+    def get_source(self, environment, template):
+        path = os.path.realpath(os.path.join(TEMPLATES_PATH, template))
+        if not os.path.exists(path):
+            raise jinja2.TemplateNotFound(template)
+        mtime = os.path.getmtime(path)
+        with file(path) as f:
+            source = f.read().decode('utf-8')
+        return source, path, lambda: mtime == os.path.getmtime(path)
+
+    def list_templates(self):
+        names = []
+        for directory, subdirectories, filenames in os.walk(TEMPLATES_PATH):
+            relative = os.path.relpath(directory, TEMPLATES_PATH)
+            names.extend([os.path.normpath(os.path.join(relative, filename)) for filename in filenames])
+        return sorted(names)
+
+
+def makeEnvironment(development=DEVELOPMENT):
+    """ in production the compiled templates are used if there are any, falling back to the source for anything else
+        like a custom base template, and nothing is checked for changes once it's loaded """
+    if development or not os.path.isdir(COMPILED_TEMPLATES_PATH):
+        return RelativeEnvironment(loader=RelativeLoader(), auto_reload=development)
+    loader = jinja2.ChoiceLoader([jinja2.ModuleLoader(COMPILED_TEMPLATES_PATH), RelativeLoader()])
+    return RelativeEnvironment(loader=loader, auto_reload=False)
@@ -14,9 +14,30 @@ import model
 UCHAR = u"\u03B4" # lowercase delta
 
 
+class FakeFetcher(object):
+    """ stands in for fetching linkback sources, serving pages from a dictionary of URL => (status code, content) """
+
+    def __init__(self):
+        self.pages = {}
+        self.fetched = []
+
+    def __call__(self, url):
+        self.fetched.append(url)
+        return self.pages.get(url)
+
+
 class BaseTestCase(unittest.TestCase):
 
     def setUp(self):
+        # blogs are kept in memory between requests, so make sure nothing carries over from another test
+        from gae_blog import cache, pagecache
+        cache.blogs.clear()
+        pagecache.pages.clear()
+
+        # never fetch anything over the network
+        from gae_blog import linkbacks
+        self.fetcher = linkbacks.fetcher = FakeFetcher()
+
         # First, create an instance of the Testbed class.
         self.testbed = testbed.Testbed()
         # Then activate the testbed, which prepares the service stubs for use.
@@ -36,8 +57,14 @@ class BaseTestCase(unittest.TestCase):
         self.mail_stub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
 
     def tearDown(self):
+        from gae_blog import linkbacks
+        linkbacks.fetcher = linkbacks.fetchUrl
         self.testbed.deactivate()
 
+    def linkingPage(self, target, title='Test Source Title' + UCHAR):
+        return (200, (u'<html><head><title>' + title + u'</title></head><body><p>Some text before the '
+            u'<a href="' + target + u'">link</a> and after' + UCHAR + u'</p></body></html>').encode('utf-8'))
+
     def executeDeferred(self, name="default"):
         # see http://stackoverflow.com/questions/6632809/gae-unit-testing-taskqueue-with-testbed
         tasks = self.task_stub.GetTasks(name)
@@ -105,7 +132,7 @@ class BaseTestCase(unittest.TestCase):
         body = ' Test Post Body' + UCHAR
         self.post = model.BlogPost(id=slug, title=title, body=body, published=True,
             author=author.key, tag_keys=tag_keys, parent=blog.key)
-        self.post.put()
+        model.putPost(self.post)
         return self.post
 
     def createComment(self, post=None):
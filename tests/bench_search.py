@@ -0,0 +1,97 @@
+# benchmarks search over a generated archive, run with `python tests/bench_search.py [number of posts]`
+# this only covers what doesn't need the datastore: building the shards and ranking what a query reads from them
+
+import bisect
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from gae_blog.config import SEARCH_SHARDS
+from gae_blog import search
+
+POSTS = 50000
+VOCABULARY = 20000
+WORDS = (50, 1000) # range of post lengths
+ENTITY_LIMIT = 1000000 # bytes
+REPEAT = 20
+
+
+def buildShards(count, terms):
+    """ generates posts of words with a zipf-like distribution, like real text, and indexes them the same way that
+        model.reindex does, only keeping the postings for the given terms so that it all fits in memory
+        returns the postings as shard id => slug => posting, and the number of shard entities there would be """
+    rng = random.Random(0)
+    vocabulary = ["w" + str(i) for i in range(VOCABULARY)]
+    cumulative = []
+    total = 0.0
+    for rank in range(1, VOCABULARY + 1):
+        total += 1.0 / rank
+        cumulative.append(total)
+
+    shards = {}
+    shard_ids = set()
+    start = 1400000000
+    for i in range(count):
+        counts = {}
+        for j in range(rng.randint(*WORDS)):
+            word = vocabulary[bisect.bisect(cumulative, rng.random() * total)]
+            counts[word] = counts.get(word, 0) + 1
+
+        slug = "post-" + str(i)
+        length = sum(counts.values())
+        shard = search.shardFor(unicode(slug))
+        for term, occurrences in counts.iteritems():
+            shard_id = search.shardId(term, shard)
+            shard_ids.add(shard_id)
+            if term in terms:
+                shards.setdefault(shard_id, {})[slug] = [occurrences, length, start + i * 3600]
+
+    return shards, len(shard_ids)
+
+
+def runQuery(shards, query, total, now):
+    terms = search.queryTerms(query)
+    postings = dict([(term, {}) for term in terms])
+    for term in terms:
+        for shard in range(SEARCH_SHARDS):
+            postings[term].update(shards.get(search.shardId(term, shard), {}))
+    return terms, search.rank(postings, total, now)
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or POSTS
+
+    queries = ["w5000", "w50", "w0", "w50 w500", "w10 w100 w1000 w10000", "w1 w2 w3 w4 w5 w6 w7 w8 w9 w10"]
+    terms = set(" ".join(queries).split())
+
+    started = time.time()
+    shards, entities = buildShards(count, terms)
+    print "indexed %d posts into %d shard entities in %.1fs" % (count, entities, time.time() - started)
+
+    # the most common term has the biggest shards
+    largest = max([len(zlib.compress(json.dumps(shards[search.shardId("w0", shard)])))
+        for shard in range(SEARCH_SHARDS)])
+    print "largest shard is %d bytes compressed (%.0f%% of the entity limit)" % (largest, 100.0 * largest / ENTITY_LIMIT)
+
+    now = time.time()
+    print
+    print "%-40s %6s %8s %10s" % ("query", "reads", "matches", "rank (ms)")
+    for query in queries:
+        timings = []
+        for i in range(REPEAT):
+            started = time.time()
+            terms, slugs = runQuery(shards, query, count, now)
+            timings.append(time.time() - started)
+        timings.sort()
+        # one batch of shards along with the post count, then one batch of cards
+        reads = len(terms) * SEARCH_SHARDS + 1
+        print "%-40s %6d %8d %10.1f" % (query, reads, len(slugs), timings[len(timings) / 2] * 1000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+from base import BaseTestCase
+
+from gae_blog import blocklist
+
+
+class TestBlocklist(BaseTestCase):
+
+    def test_parseAddress(self):
+        assert blocklist.parseAddress('192.168.1.1') == (4, 0xc0a80101)
+        assert blocklist.parseAddress('2001:db8::1') == (6, 0x20010db8 << 96 | 1)
+        assert blocklist.parseAddress('::') == (6, 0)
+        assert blocklist.parseAddress('::ffff:192.168.1.1') == (4, 0xc0a80101)
+
+        for invalid in ['', '192.168.1', '192.168.1.256', '1::2::3', '1:2:3:4:5:6:7:8:9', 'abcde::', 'not an address']:
+            assert blocklist.parseAddress(invalid) is None
+
+    def test_parseEntry(self):
+        assert blocklist.parseEntry('192.168.1.1') == (4, 0xc0a80101, 0xc0a80101)
+        assert blocklist.parseEntry('192.168.1.77/24') == (4, 0xc0a80100, 0xc0a801ff)
+        assert blocklist.parseEntry('2001:db8::/32') == (6, 0x20010db8 << 96, (0x20010db9 << 96) - 1)
+        assert blocklist.parseEntry('::ffff:10.0.0.0/104') == (4, 0x0a000000, 0x0affffff)
+
+        for invalid in ['192.168.1.1/33', '2001:db8::/129', '192.168.1.1/', '192.168.1.1/x']:
+            assert blocklist.parseEntry(invalid) is None
+
+    def test_splitEntries(self):
+        assert blocklist.splitEntries('1.1.1.1\r\n\r\n2.2.2.2, 3.3.3.3') == ['1.1.1.1', '2.2.2.2', '3.3.3.3']
+
+    def test_contains(self):
+        blocked = blocklist.Blocklist(['10.0.0.0/8', '10.1.0.0/16', '11.0.0.0/8', '192.168.1.1', '2001:db8::/32',
+            'invalid'])
+
+        # overlapping and neighbouring ranges are merged together
+        assert len(blocked) == 3
+
+        assert '10.255.0.1' in blocked
+        assert '11.0.0.1' in blocked
+        assert '12.0.0.0' not in blocked
+        assert '192.168.1.1' in blocked
+        assert '192.168.1.2' not in blocked
+        assert '::ffff:192.168.1.1' in blocked
+        assert '2001:db8:ffff::1' in blocked
+        assert '2001:db9::1' not in blocked
+        assert '' not in blocked
+        assert None not in blocked
@@ -0,0 +1,129 @@
+import datetime
+
+from google.appengine.api import memcache
+
+from base import BaseTestCase
+
+from gae_blog import cache
+
+
+class TestLRUCache(BaseTestCase):
+
+    def test_lru(self):
+        lru = cache.LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+
+        # using an entry keeps it around longer
+        assert lru.get('a') == 1
+        lru.set('c', 3)
+
+        assert len(lru) == 2
+        assert lru.get('b') is None
+        assert lru.get('a') == 1
+        assert lru.get('c') == 3
+
+        lru.delete('a')
+        assert lru.get('a', 'default') == 'default'
+
+        lru.clear()
+        assert len(lru) == 0
+
+
+class TestBlogCache(BaseTestCase):
+
+    def test_getBlogAsync(self):
+        assert cache.getBlogAsync('blog').get_result() is None
+        assert cache.blogs.get('blog') is None
+
+        blog = self.createBlog()
+        cached = cache.getBlogAsync('blog').get_result()
+        assert cached.key == blog.key
+        assert cache.blogs.get('blog')[0] is cached
+
+        # within the TTL the same copy is used without checking anything
+        memcache.flush_all()
+        assert cache.getBlogAsync('blog').get_result() is cached
+
+        # after the TTL the version is checked, and since memcache was flushed it's reloaded
+        entry = cache.blogs.get('blog')
+        cache.blogs.set('blog', (entry[0], entry[1], 0))
+        cache.getBlogAsync('blog').get_result()
+        assert cache.blogs.get('blog')[1] != entry[1]
+
+        # an unchanged version just renews the check
+        entry = cache.blogs.get('blog')
+        cache.blogs.set('blog', (entry[0], entry[1], 0))
+        cache.getBlogAsync('blog').get_result()
+        assert cache.blogs.get('blog')[1] == entry[1]
+        assert cache.blogs.get('blog')[2] > 0
+
+    def test_bumpBlogVersion(self):
+        self.createBlog()
+        cache.getBlogAsync('blog').get_result()
+        version = cache.getBlogVersionAsync('blog').get_result()
+
+        cache.bumpBlogVersion('blog')
+
+        assert cache.blogs.get('blog') is None
+        assert cache.getBlogVersionAsync('blog').get_result() != version
+
+    def test_refreshBlog(self):
+        self.createBlog()
+        cache.getBlogAsync('blog').get_result()
+        version = cache.getBlogVersionAsync('blog').get_result()
+
+        assert not cache.refreshBlog('blog', version)
+        assert cache.blogs.get('blog')
+
+        # another instance saved the blog, so the copy here is thrown away even within its TTL
+        memcache.set(cache.BLOG_VERSION_KEY + '|blog', 'new-version')
+        assert cache.checkPage('blog', '/blog', [cache.BLOG])[1][cache.VERSION] == 'new-version'
+        assert cache.refreshBlog('blog', 'new-version')
+        assert cache.blogs.get('blog') is None
+
+
+class TestGenerations(BaseTestCase):
+
+    def test_checkPage(self):
+        current, generations = cache.checkPage('blog', '/blog', [cache.BLOG, cache.POSTS])
+        assert not current
+        assert sorted(generations.keys()) == [cache.BLOG, cache.POSTS]
+
+        cache.savePage('/blog', generations)
+        assert cache.checkPage('blog', '/blog', [cache.BLOG, cache.POSTS]) == (True, generations)
+
+        # only the pages depending on what changed are thrown away
+        cache.savePage('/blog/contact', cache.checkPage('blog', '/blog/contact', [cache.BLOG])[1])
+        cache.bumpGenerations('blog', [cache.POSTS])
+
+        assert not cache.checkPage('blog', '/blog', [cache.BLOG, cache.POSTS])[0]
+        assert cache.checkPage('blog', '/blog/contact', [cache.BLOG])[0]
+
+        # losing a generation makes everything depending on it out of date
+        memcache.delete(cache.generationKey('blog', cache.BLOG))
+        assert not cache.checkPage('blog', '/blog/contact', [cache.BLOG])[0]
+
+    def test_validators(self):
+        current, generations = cache.checkPage('blog', '/blog', [cache.BLOG, cache.POSTS])
+        etag = cache.pageETag('/blog', generations)
+
+        assert cache.pageETag('/blog', dict(generations)) == etag
+        assert cache.pageETag('/blog/feed', generations) != etag
+        assert cache.lastModified(generations) <= datetime.datetime.utcnow()
+
+        # generations saved before they had times aren't used for dates
+        assert cache.lastModified({cache.BLOG: 'abc'}) is None
+        assert cache.lastModified({cache.BLOG: '100-abc', cache.POSTS: '200-def'}) == datetime.datetime.utcfromtimestamp(200)
+
+    def test_postGenerations(self):
+        tag = self.createTag()
+        post = self.createPost(tags=[tag])
+
+        names = cache.postGenerations(post)
+        assert sorted(names) == [cache.AUTHOR + self.author.slug, cache.POST + post.slug, cache.POSTS,
+            cache.TAG + tag.slug]
+
+        # an unpublished post isn't listed anywhere
+        post.published = False
+        assert cache.postGenerations(post) == [cache.POST + post.slug]
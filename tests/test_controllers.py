@@ -1,11 +1,13 @@
 import datetime
 import logging
 import os
+import time
 import xmlrpclib
+from email.utils import formatdate
 
 import jinja2
 
-from google.appengine.api import memcache
+from google.appengine.api import memcache, taskqueue
 
 from webtest import TestApp
 
@@ -14,6 +16,9 @@ from controllers import admin as controller_admin
 
 from base import BaseTestCase, UCHAR, model
 
+from gae_blog import cache, pagecache, throttle
+from gae_blog.config import DIGEST_QUEUE
+
 
 class BaseTestController(BaseTestCase):
 
@@ -279,6 +284,30 @@ class TestBase(BaseMockController):
         assert len(messages) == 1
         assert "Comment Awaiting Moderation" in messages[0].subject
 
+    def test_queueDigest(self):
+        blog = self.createBlog()
+        blog.moderation_alert = True
+        blog.admin_email = "test.admin" + UCHAR + "@example.com"
+        blog.digest_interval = 60
+        post = self.createPost(blog=blog)
+        comment = self.createComment(post=post)
+        self.controller.blog = blog
+
+        # every alert in the interval shares one digest
+        for i in range(3):
+            self.controller.linkbackEmail(post, comment)
+
+        assert len(self.task_stub.GetTasks("mail")) == 1
+
+        self.executeDeferred(name="mail")
+        messages = self.mail_stub.get_sent_messages()
+        assert len(messages) == 1
+        assert "3 Awaiting Moderation" in messages[0].subject
+        assert "3 Comment" in str(messages[0].body)
+
+        # and the alerts are gone once they've been sent
+        assert not taskqueue.Queue(DIGEST_QUEUE).lease_tasks(60, 10)
+
 
 class TestForm(BaseMockController):
 
@@ -374,6 +403,24 @@ class TestForm(BaseMockController):
 
         assert not bot
 
+    def test_throttled(self):
+        blog = self.createBlog()
+        blog.ip_write_budget = 2
+        self.controller.blog = blog
+
+        assert not self.controller.throttled()
+        assert not self.controller.throttled()
+
+        # the budget for this address has run out
+        assert self.controller.throttled()
+        assert self.controller.response.status_int == 503
+        assert self.controller.response.headers["Retry-After"] == "1800"
+        assert throttle.firedCounts(blog.slug) == {throttle.IP: 1, throttle.BLOG: 0}
+
+        # no budget means no limit
+        blog.ip_write_budget = 0
+        assert not self.controller.throttled()
+
     def test_generateToken(self):
         salt = "static salt for testing generateToken"
         memcache.set(self.controller.SALT_KEY, salt)
@@ -546,6 +593,7 @@ class TestFeed(BaseTestController):
         assert self.blog.title in response
         assert self.post.title in response
         assert "<category>" + tag.name + "</category>" in response
+        assert "<dc:creator>" + author.name + "</dc:creator>" in response
 
         response = self.app.get('/feed?author=' + author.slug)
         assert "Author - " + author.name not in response
@@ -558,6 +606,127 @@ class TestFeed(BaseTestController):
         response = self.app.get('/feed?tag=' + tag.slug)
         assert "Tag - " + tag.name in response
 
+    def setTime(self, seconds):
+        # pretends that generations are made and pages are validated at a different time
+        for module in (cache, controller_base):
+            self.addCleanup(setattr, module, "time", module.time)
+            module.time = type("Time", (object,), {"time": staticmethod(lambda: seconds)})
+
+    def test_conditional(self):
+        now = time.time()
+        self.setTime(now)
+        self.createBlog()
+        self.createPost()
+
+        # dates are only to the second, so none is given until the second the feed last changed in is over
+        response = self.app.get('/feed')
+        assert 'Last-Modified' not in response.headers
+        assert self.app.get('/feed', headers=[('If-Modified-Since', formatdate(now, usegmt=True))], status=200)
+
+        self.setTime(now + 1)
+        response = self.app.get('/feed')
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        # a client that already has the feed isn't sent it again
+        response = self.app.get('/feed', headers=[('If-None-Match', etag)], status=304)
+        assert not response.body
+        assert response.headers['ETag'] == etag
+        assert self.app.get('/feed', headers=[('If-Modified-Since', last_modified)], status=304)
+
+        # other pages and query strings have their own
+        assert self.app.get('/feed?tag=test', headers=[('If-None-Match', etag)], status=200)
+
+        # until a new post changes it
+        cache.bumpGenerations('blog', [cache.POSTS])
+        response = self.app.get('/feed', headers=[('If-None-Match', etag)], status=200)
+        assert response.headers['ETag'] != etag
+
+        # pages can look different for users, so they're always sent in full
+        self.login()
+        etag = response.headers['ETag']
+        assert self.app.get('/feed', headers=[('If-None-Match', etag)], status=200)
+
+    def test_pageCache(self):
+        self.createBlog()
+        self.createPost()
+        # nothing is cached on the development server
+        server = os.environ['SERVER_SOFTWARE']
+        os.environ['SERVER_SOFTWARE'] = 'Google App Engine/1.9.0'
+        try:
+            assert self.post.title in self.app.get('/feed')
+
+            # changes that haven't bumped a generation aren't seen yet
+            self.post.title = 'Changed Title'
+            self.post.put()
+            assert 'Changed Title' not in self.app.get('/feed')
+
+            # the copy in memcache is used when another instance doesn't have one
+            pagecache.pages.clear()
+            assert 'Changed Title' not in self.app.get('/feed')
+            assert len(pagecache.pages) == 1
+
+            # pages can look different for users, so they're always rendered
+            self.login()
+            assert 'Changed Title' in self.app.get('/feed')
+            os.environ['USER_EMAIL'] = ''
+
+            # while another request is rendering the page the last copy is served, without validators
+            key = list(pagecache.pages.entries.keys())[0]
+            memcache.add(pagecache.LEASE_KEY + '|' + key, 1)
+            cache.bumpGenerations('blog', [cache.POSTS])
+            response = self.app.get('/feed')
+            assert 'Changed Title' not in response
+            assert 'ETag' not in response.headers
+
+            # the request that takes the lease serves it too, and leaves rendering it to a task
+            memcache.delete(pagecache.LEASE_KEY + '|' + key)
+            assert 'Changed Title' not in self.app.get('/feed')
+            self.executeDeferred()
+            assert 'Changed Title' in self.app.get('/feed')
+            assert not memcache.get(pagecache.LEASE_KEY + '|' + key)
+        finally:
+            os.environ['SERVER_SOFTWARE'] = server
+
+    def test_pageCacheGone(self):
+        self.createBlog()
+        post = self.createPost()
+        server = os.environ['SERVER_SOFTWARE']
+        os.environ['SERVER_SOFTWARE'] = 'Google App Engine/1.9.0'
+        try:
+            assert post.title in self.app.get('/post/' + post.slug)
+
+            model.deletePost(post)
+            cache.bumpGenerations('blog', cache.postGenerations(post))
+            assert post.title in self.app.get('/post/' + post.slug)
+
+            # once the task finds it's gone the last copy is thrown away instead of being served again
+            self.executeDeferred()
+            assert not pagecache.pages.entries
+            assert self.app.get('/post/' + post.slug, status=404)
+        finally:
+            os.environ['SERVER_SOFTWARE'] = server
+
+    def test_pageCacheDatastore(self):
+        generations = {cache.BLOG: '1-a'}
+        pagecache.savePage('localhost/blog', generations, 'text/html', 'page', use_datastore=True)
+        pagecache.pages.clear()
+        memcache.flush_all()
+
+        assert pagecache.getEntry('localhost/blog', generations) is None
+        assert pagecache.getEntry('localhost/blog', generations, use_datastore=True)[:3] == (generations,
+            'text/html', 'page')
+        # an out of date copy is still found for serving while the page is rendered again
+        assert pagecache.getEntry('localhost/blog', {cache.BLOG: '2-b'}, use_datastore=True)[0] == generations
+
+    def test_pageCacheExpiring(self):
+        now = 1000000
+        # a page that rendered instantly is never rendered again early
+        assert not pagecache.expiring(({}, '', '', now, 0), now=now + pagecache.PAGE_CACHE_TTL - 1)
+        assert pagecache.expiring(({}, '', '', now, 0), now=now + pagecache.PAGE_CACHE_TTL)
+        # one that takes far longer to render than it lasts is all but certain to be
+        assert pagecache.expiring(({}, '', '', now, pagecache.PAGE_CACHE_TTL * 10 ** 9), now=now + 1)
+
 
 class TestIndex(BaseTestController):
 
@@ -574,6 +743,104 @@ class TestIndex(BaseTestController):
         response = self.app.get('')
         assert post.body in response
 
+    def test_summaries(self):
+        blog = self.createBlog(url='blog')
+        blog.summaries = True
+        blog.put()
+
+        # posts saved before they had cards or excerpts are still listed
+        post = self.createPost()
+        post.card.key.delete()
+        post.excerpt = None
+        post.put()
+
+        response = self.app.get('')
+        assert post.title in response
+        assert post.body.strip() in response
+
+        response = self.app.get('/feed')
+        assert post.title in response
+        assert post.body.strip() in response
+
+    def test_pagination(self):
+        blog = self.createBlog(url='blog')
+        blog.posts_per_page = 1
+        post1 = self.createPost(slug='first-test-post')
+        post2 = self.createPost(slug='second-test-post')
+        post3 = self.createPost(slug='third-test-post')
+
+        # the newest post is on the last page, which is shown by default
+        response = self.app.get('')
+        assert post3.slug in response
+        assert post2.slug not in response
+
+        response = self.app.get('?page=2')
+        assert post2.slug in response
+        assert post1.slug not in response
+
+        # that request left a cursor at the boundary of the next page, which this one starts from
+        response = self.app.get('?page=1')
+        assert post1.slug in response
+        assert post2.slug not in response
+
+        assert self.app.get('?page=3', status=404)
+
+        response = self.app.get('?page=0')
+        assert response.status_int == 301
+
+    def test_fetchPage(self):
+        blog = self.createBlog()
+        post1 = self.createPost(slug='first-test-post')
+        post2 = self.createPost(slug='second-test-post')
+
+        from controllers import index as controller_index
+        controller = controller_index.IndexController()
+        query = blog.published_posts
+        prefix = 'test-prefix'
+
+        posts = controller.fetchPage(query, prefix, 0, 1)
+        assert [post.key for post in posts] == [post2.key]
+        assert memcache.get(prefix + '|1')
+
+        posts = controller.fetchPage(query, prefix, 1, 1)
+        assert [post.key for post in posts] == [post1.key]
+
+        # a bad cursor falls back to an offset
+        memcache.set(prefix + '|1', 'not a cursor')
+        posts = controller.fetchPage(query, prefix, 1, 1)
+        assert [post.key for post in posts] == [post1.key]
+
+
+class TestSearch(BaseTestController):
+
+    def test_search(self):
+        # no blog
+        assert self.app.get('/search?q=test', status=403)
+
+        self.createBlog()
+        response = self.app.get('/search')
+        assert 'name="q"' in response
+        assert "No posts found." not in response
+
+        post = self.createPost()
+        self.executeDeferred(name="search")
+
+        response = self.app.get('/search?q=post')
+        assert "1 Post Found" in response
+        assert post.title in response
+
+        response = self.app.get('/search?q=nothing')
+        assert "No posts found." in response
+
+        # pages past the results don't exist
+        assert self.app.get('/search?q=post&page=1', status=404)
+        assert self.app.get('/search?q=post&page=nothing', status=404)
+
+        # the query is shown back escaped
+        response = self.app.get('/search', {'q': '"><script>alert(1)</script>'})
+        assert '<script>alert(1)</script>' not in response
+        assert '&#34;&gt;&lt;script&gt;alert(1)&lt;/script&gt;' in response
+
 
 class TestPost(BaseTestController):
 
@@ -702,6 +969,23 @@ class TestPost(BaseTestController):
         assert "(post author)" in response
         assert data["body"] in response
 
+        # admins can add linkbacks, which get receipts like any other
+        data = {}
+        data["url"] = "http://www.example.com/linkback"
+        data["email"] = comment.email.encode("utf-8")
+        data["pingback"] = "on"
+        data["token"] = token
+
+        response = self.app.post(path, data)
+        assert response.location.endswith('#comments')
+        assert model.linkbackReceiptKey(post.key, "pingback", data["url"]).get()
+        assert model.getCount(post.key, model.LINKBACKS) == 1
+
+        # so the same one can't be added twice
+        response = self.app.post(path, data)
+        assert response.location.endswith('#comment-link')
+        assert post.comments.filter(model.BlogComment.pingback == True).count() == 1
+
 
 class TestTrackback(BaseTestController):
 
@@ -747,11 +1031,21 @@ class TestTrackback(BaseTestController):
         data["title"] = ("Test Trackback Post Title" + UCHAR).encode("utf-8")
         data["url"] = "http://www.example.com/trackback-test"
 
+        # the source doesn't link to the post, so it's dropped once it's been checked
+        response = self.app.post(path, data)
+        assert '<error>0</error>' in response
+
+        self.executeDeferred(name="linkbacks")
+        assert self.fetcher.fetched == [data["url"]]
+        assert not post.comments.count()
+
         # unapproved, so comment should not be there
+        self.fetcher.pages[data["url"]] = self.linkingPage("http://localhost/blog/post/" + post.slug)
         response = self.app.post(path, data)
         assert '<error>0</error>' in response
 
-        # and a moderation email should've been sent
+        # and a moderation email should've been sent once it was verified
+        self.executeDeferred(name="linkbacks")
         self.executeDeferred(name="mail")
 
         messages = self.mail_stub.get_sent_messages()
@@ -848,11 +1142,13 @@ class TestPingback(BaseTestController):
         post.published = True
 
         # unapproved, so comment should not be there
+        self.fetcher.pages[params[0]] = self.linkingPage(params[1])
         response = self.app.request('/pingback', method='POST', body=body)
         assert '<fault>' not in response
         assert 'Pingback Receieved Successfully' in response
 
-        # and a moderation email should've been sent
+        # and a moderation email should've been sent once it was verified
+        self.executeDeferred(name="linkbacks")
         self.executeDeferred(name="mail")
 
         messages = self.mail_stub.get_sent_messages()
@@ -920,10 +1216,12 @@ class TestWebmention(BaseTestController):
         post.published = True
 
         # unapproved, so comment should not be there
+        self.fetcher.pages[data["source"]] = self.linkingPage(data["target"])
         response = self.app.post('/webmention', data)
         assert 'Awaiting Moderation' in response
 
-        # and a moderation email should've been sent
+        # and a moderation email should've been sent once it was verified
+        self.executeDeferred(name="linkbacks")
         self.executeDeferred(name="mail")
 
         messages = self.mail_stub.get_sent_messages()
@@ -1017,12 +1315,62 @@ class TestAdmin(BaseTestController):
         data["author_pages"] = '1'
         data["admin_email"] = ('test.admin' + UCHAR + '@example.com').encode('utf-8')
         data["moderation_alert"] = '1'
+        data["digest_interval"] = '0'
+        data["ip_write_budget"] = '20'
+        data["blog_write_budget"] = '1000'
         data["contact"] = '1'
 
+        # a negative budget would refuse every write
+        data["ip_write_budget"] = '-1'
+        response = self.app.post('/admin/blog', data)
+        response = response.follow()
+        assert 'please enter a whole number of 0 or more' in response
+        data["ip_write_budget"] = '20'
+
         response = self.app.post('/admin/blog', data)
         response = response.follow()
         assert '<h3>Author</h3>' in response
 
+    def test_renameBlog(self):
+        blog = self.createBlog()
+        comment = self.createComment()
+        self.login(is_admin=True)
+
+        data = {"title": 'Renamed Blog', "url": 'new-blog', "mail_queue": 'mail', "posts_per_page": '10',
+            "image_preview_size": '600', "digest_interval": '0', "ip_write_budget": '20', "blog_write_budget": '1000'}
+
+        # the blog stays where it is while it's being copied
+        response = self.app.post('/admin/blog', data)
+        response = response.follow()
+        assert 'Moving to /new-blog' in response
+
+        # and it can't be moved again in the meantime
+        data["url"] = 'other-blog'
+        response = self.app.post('/admin/blog', data).follow()
+        assert "finished moving" in response
+
+        self.executeDeferred()
+
+        assert not model.Blog.get_by_id('blog')
+        new_blog = model.Blog.get_by_id('new-blog')
+        assert new_blog.title == 'Renamed Blog'
+
+        post = model.BlogPost.get_by_id(self.post.slug, parent=new_blog.key)
+        assert post.author.parent() == new_blog.key
+        assert post.comments.get().body == comment.body
+        assert new_blog.published_count == 1
+
+        response = self.app.get('/admin')
+        assert response.location.endswith('/new-blog/admin')
+
+        # a blog that takes the old slug again, like one renamed back, can still be moved itself
+        cache.blogs.clear()
+        self.createBlog()
+        data["url"] = 'other-blog'
+        response = self.app.post('/admin/blog', data).follow()
+        assert "finished moving" not in response
+        assert 'Moving to /other-blog' in response
+
     def test_authors(self):
         self.createBlog()
         self.login(is_admin=True)
@@ -1089,6 +1437,11 @@ class TestAdmin(BaseTestController):
         response = self.app.get('/admin/posts')
         assert post.title in response
 
+        # posts saved before they had cards are still listed
+        post.card.key.delete()
+        response = self.app.get('/admin/posts')
+        assert post.title in response
+
     def test_deletePost(self):
         blog = self.createBlog()
         post = self.createPost(blog=blog)
@@ -1172,6 +1525,49 @@ class TestAdmin(BaseTestController):
         comment = self.createComment()
         response = self.app.get('/admin/comments')
         assert comment.body in response
+        assert self.post.title in response
+
+        # the queue is shown a page at a time
+        self.createComment()
+        response = self.app.get('/admin/comments?size=1')
+        assert 'Next Page' in response
+        assert 'First Page' not in response
+
+        response = response.click('Next Page')
+        assert 'First Page' in response
+        assert 'Next Page' not in response
+
+        assert self.app.get('/admin/comments?cursor=invalid', status=400)
+
+    def test_moderateComments(self):
+        blog = self.createBlog()
+        blog.enable_comments = True
+        self.login(is_admin=True)
+
+        comments = [self.createComment() for i in range(3)]
+        for i, comment in enumerate(comments):
+            comment.ip_address = '192.168.1.' + str(i)
+            comment.put()
+
+        assert self.app.post('/admin/comments', {'action': 'nothing'}, status=400)
+        assert self.app.post('/admin/comments', {'action': 'delete', 'comments': self.post.key.urlsafe()}, status=400)
+
+        # approving more than one at once
+        data = [('action', 'approve'), ('comments', comments[0].key.urlsafe()), ('comments', comments[1].key.urlsafe())]
+        self.app.post('/admin/comments', data)
+
+        assert comments[0].key.get().approved
+        assert comments[1].key.get().approved
+        assert model.getCount(self.post.key, model.COMMENTS) == 2
+
+        # blocking and deleting
+        data = [('action', 'block'), ('comments', comments[1].key.urlsafe()), ('comments', comments[2].key.urlsafe())]
+        self.app.post('/admin/comments', data)
+
+        assert not comments[1].key.get()
+        assert not comments[2].key.get()
+        assert model.getCount(self.post.key, model.COMMENTS) == 1
+        assert blog.key.get().blocklist == ['192.168.1.1', '192.168.1.2']
 
     def test_moderateComment(self):
         blog = self.createBlog()
@@ -1262,32 +1658,84 @@ class TestAdmin(BaseTestController):
         self.createBlog()
         self.login(is_admin=True)
 
-        assert self.app.get('/admin/migrate', status=405)
+        response = self.app.get('/admin/migrate')
+        assert 'never run' in response
 
-        assert self.app.post('/admin/migrate', status=302)
+        assert self.app.post('/admin/migrate', {'migration': 'nothing'}, status=400)
 
-    def test_getCacheKeys(self):
-        post = self.createPost()
-        post.published = True
+        response = self.app.post('/admin/migrate', {'migration': 'receipts'}).follow()
+        assert 'queued' in response
 
-        keys = controller_admin.getCacheKeys(self.blog)
-        assert keys == ['/blog', '/blog/contact', '/blog/feed', '/blog/post/test-post', '/blog/author/test-author']
+        self.executeDeferred()
+        response = self.app.get('/admin/migrate')
+        assert 'done' in response
 
-    def test_getDatastoreKeys(self):
-        post = self.createPost()
-        post.published = True
+    def test_stats(self):
+        self.createBlog()
+        self.login(is_admin=True)
 
-        keys = controller_admin.getDatastoreKeys(self.blog)
-        assert keys == [model.ndb.Key('HTMLCache', '/blog/feed')]
+        response = self.app.get('/admin/stats')
+        assert 'AdminController' not in response
 
-    def test_clearCache(self):
+        # every request so far has been timed
+        self.app.get('/')
+        response = self.app.get('/admin/stats')
+        assert 'IndexController' in response
+        assert 'StatsController' in response
+
+    def test_postPaths(self):
+        tag = self.createTag()
+        post = self.createPost(tags=[tag])
+
+        paths = controller_admin.postPaths(self.blog, post)
+        assert paths == ['/blog', '/blog/feed', '/blog/post/' + post.slug, '/blog/tag/' + tag.slug]
+
+        self.blog.author_pages = True
+        assert controller_admin.postPaths(self.blog, post)[-1] == '/blog/author/' + self.author.slug
+
+    def test_publishPost(self):
+        self.createBlog()
         post = self.createPost()
-        post.published = True
+        post.timestamp = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        model.putPost(post)
+        current, generations = cache.checkPage('blog', '/blog', [cache.BLOG, cache.POSTS])
+        publish = controller_admin.PostController.publishPost
+
+        # nothing happens before it's live, except trying again later
+        queued = len(self.task_stub.GetTasks('default'))
+        publish('blog', post.slug, post.timestamp, 'http://localhost', 'localhost')
+        assert self.blog.published_count == 0
+        assert len(self.task_stub.GetTasks('default')) == queued + 1
+
+        # or if it was rescheduled since
+        timestamp = post.timestamp
+        post.timestamp = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+        post.put()
+        publish('blog', post.slug, timestamp, 'http://localhost', 'localhost')
+        assert self.blog.published_count == 0
+
+        server = os.environ['SERVER_SOFTWARE']
+        os.environ['SERVER_SOFTWARE'] = 'Google App Engine/1.9.0'
+        try:
+            publish('blog', post.slug, post.timestamp, 'http://localhost', 'localhost')
+        finally:
+            os.environ['SERVER_SOFTWARE'] = server
+
+        assert self.blog.published_count == 1
+        assert cache.checkPage('blog', '/blog', [cache.BLOG, cache.POSTS])[1] != generations
+        # the pages it's on are ready for the first people to see it
+        entry = pagecache.pages.get('localhost/blog')
+        assert post.title.encode('utf-8') in entry[2]
+        assert pagecache.pages.get('localhost/blog/post/' + post.slug)
+
+    def test_clearCache(self):
+        current, generations = cache.checkPage('blog', '/blog', [cache.BLOG])
+        cache.savePage('/blog', generations)
 
         controller_admin.clearCache(self.blog)
 
-        keys = controller_admin.getCacheKeys(self.blog)
-        assert not memcache.get_multi(keys)
+        current, generations = cache.checkPage('blog', '/blog', [cache.BLOG])
+        assert not current
 
 
 def inList(string, list):
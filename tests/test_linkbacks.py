@@ -0,0 +1,45 @@
+from base import BaseTestCase, UCHAR
+
+from gae_blog import linkbacks
+
+
+class TestLinkbacks(BaseTestCase):
+
+    TARGET = 'http://localhost/blog/post/test-post'
+
+    def test_normalizeUrl(self):
+        assert linkbacks.normalizeUrl('https://LOCALHOST/blog/post/test-post/#comments') == \
+            linkbacks.normalizeUrl(self.TARGET)
+        assert linkbacks.normalizeUrl(self.TARGET + '?page=1') != linkbacks.normalizeUrl(self.TARGET)
+
+    def test_parseSource(self):
+        status, content = self.linkingPage(self.TARGET)
+        parser = linkbacks.parseSource(content, self.TARGET)
+
+        assert parser.linked
+        assert parser.title == 'Test Source Title' + UCHAR
+        assert parser.excerpt == u'[...] Some text before the link and after' + UCHAR + u' [...]'
+
+        # scripts aren't part of the excerpt and a broken page still gets read as far as it makes sense
+        content = '<script>var a = "<a href=\'' + self.TARGET + '\'>";</script><p>text</p><a href="' + self.TARGET + '">x</a><!'
+        parser = linkbacks.parseSource(content, self.TARGET)
+        assert parser.linked
+        assert 'var' not in parser.excerpt
+
+        parser = linkbacks.parseSource('<a href="http://www.example.com/">elsewhere</a>', self.TARGET)
+        assert not parser.linked
+
+    def test_verify(self):
+        source = 'http://www.example.com/source'
+
+        # not found
+        assert not linkbacks.verify(source, self.TARGET)
+
+        self.fetcher.pages[source] = (404, self.linkingPage(self.TARGET)[1])
+        assert not linkbacks.verify(source, self.TARGET)
+
+        self.fetcher.pages[source] = self.linkingPage('http://www.example.com/')
+        assert not linkbacks.verify(source, self.TARGET)
+
+        self.fetcher.pages[source] = self.linkingPage(self.TARGET)
+        assert linkbacks.verify(source, self.TARGET).linked
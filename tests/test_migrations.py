@@ -0,0 +1,49 @@
+from base import BaseTestCase
+
+from gae_blog import migrations, model
+
+
+class TestMigrations(BaseTestCase):
+
+    def test_start(self):
+        post = self.createPost()
+        second = self.createPost(slug='second-post')
+        comment = self.createComment(post=post)
+        comment.approved = True
+        comment.put()
+        model.ndb.delete_multi(model.BlogCounter.query(ancestor=self.blog.key).fetch(keys_only=True))
+        model.ndb.delete_multi([post.card.key, second.card.key])
+
+        # a batch at a time
+        migrations.BY_NAME["post_counts"].batch = 1
+        try:
+            migrations.start(self.blog, ["summaries", "post_counts", "comment_counts"])
+            self.executeDeferred()
+        finally:
+            del migrations.BY_NAME["post_counts"].batch
+
+        assert self.blog.published_count == 2
+        assert model.getCount(post.key, model.COMMENTS) == 1
+        assert self.blog.cards.count() == 2
+
+        statuses = dict([(migration.name, status) for migration, status in migrations.getStatuses(self.blog)])
+        assert statuses["post_counts"].state == migrations.DONE
+        assert statuses["post_counts"].processed == 2
+        assert statuses["image_urls"] is None
+
+        # running again starts over rather than adding to the counts twice
+        migrations.start(self.blog, ["post_counts"])
+        self.executeDeferred()
+
+        assert self.blog.published_count == 2
+
+    def test_run(self):
+        self.createPost()
+        migrations.start(self.blog, ["post_counts"])
+
+        # a task that runs twice only does its batch once
+        migrations.run(self.blog.slug, ["post_counts"], 0)
+        migrations.run(self.blog.slug, ["post_counts"], 0)
+
+        status = migrations.BlogMigration.get_by_id("post_counts", parent=self.blog.key)
+        assert status.processed == 1
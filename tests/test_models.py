@@ -3,11 +3,52 @@ import datetime
 
 from base import BaseTestCase, UCHAR
 
+import migrations
 import model
 
 
+def renameTask(old_slug, step):
+    # the tests run each step themselves
+    pass
+
+
+class TestBlog(BaseTestCase):
+
+    def test_blocks(self):
+        blog = self.createBlog()
+        blog.blocklist = ['192.168.1.0/24']
+
+        assert blog.blocks('192.168.1.77')
+        assert not blog.blocks('192.168.2.1')
+
+        # changes to the list are picked up without waiting for a new copy of the blog
+        blog.blocklist.append('192.168.2.1')
+        assert blog.blocks('192.168.2.1')
+
+        blog.blocklist = []
+        assert not blog.blocks('192.168.1.77')
+
+
 class TestBlogPost(BaseTestCase):
 
+    def test_prefetchPosts(self):
+        tag = self.createTag()
+        post = self.createPost(tags=[tag])
+        comment = self.createComment(post=post)
+        comment.approved = True
+        model.putComments([comment])
+        blog = post.blog
+        blog.enable_comments = True
+
+        posts = model.prefetchPosts([post])
+
+        assert posts == [post]
+        assert post._prefetched["author"].key == self.author.key
+        assert [t.key for t in post._prefetched["tags"]] == [tag.key]
+        assert post.author_entity.key == self.author.key
+        assert post.tag_names == [tag.name]
+        assert post.comment_count(blog) == 1
+
     def test_summarize(self):
         post = self.createPost()
         post.body = 'test body for summarize' + UCHAR
@@ -18,6 +59,28 @@ class TestBlogPost(BaseTestCase):
         short = post.summarize(2)
         assert short == 'test body...'
 
+    def test_updateSummary(self):
+        post = self.createPost()
+        post.body = '<p>test body for <b>summary</b></p>' + UCHAR
+        post.updateSummary()
+
+        assert post.excerpt == 'test body for summary' + UCHAR
+        assert post.word_count == 4
+        assert post.reading_time == 1
+
+        post.body = ' '.join(['word'] * (model.EXCERPT_LENGTH + model.WORDS_PER_MINUTE))
+        post.updateSummary()
+
+        assert post.excerpt == ' '.join(['word'] * model.EXCERPT_LENGTH) + '...'
+        assert post.word_count == model.EXCERPT_LENGTH + model.WORDS_PER_MINUTE
+        assert post.reading_time == 2
+
+        post.body = ''
+        post.updateSummary()
+
+        assert post.excerpt == ''
+        assert post.reading_time == 0
+
     def test_enabled_comments(self):
         comment1 = self.createComment()
         comment1.approved = True
@@ -46,6 +109,30 @@ class TestBlogPost(BaseTestCase):
 
         assert len(post.enabled_comments(blog)) == 1
 
+    def test_comment_count(self):
+        comment1 = self.createComment()
+        comment1.approved = True
+        comment2 = self.createComment()
+        comment2.approved = True
+        comment2.trackback = True
+        model.putComments([comment1, comment2])
+        post = comment1.post
+        blog = post.blog
+
+        assert post.comment_count(blog) == 0
+
+        blog.enable_comments = True
+
+        assert post.comment_count(blog) == 1
+
+        blog.enable_linkbacks = True
+
+        assert post.comment_count(blog) == 2
+
+        model.deleteComments([comment1])
+
+        assert post.comment_count(blog) == 1
+
 
 class TestModelFunctions(BaseTestCase):
 
@@ -63,6 +150,196 @@ class TestModelFunctions(BaseTestCase):
         assert html == 'text with <a href="http://www.example.com" target="_blank">http://www.example.com</a> links'
 
 
+    def test_putPost(self):
+        tag = self.createTag()
+        post = self.createPost(tags=[tag])
+
+        assert self.blog.published_count == 1
+        assert self.author.published_count == 1
+        assert tag.published_count == 1
+
+        # saving again doesn't count it twice
+        model.putPost(post)
+
+        assert self.blog.published_count == 1
+
+        # unpublishing removes it from every count
+        post.published = False
+        model.putPost(post)
+
+        assert self.blog.published_count == 0
+        assert self.author.published_count == 0
+        assert tag.published_count == 0
+
+        # a post in the future isn't counted until it goes live
+        post.published = True
+        post.timestamp = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        model.putPost(post)
+
+        assert self.blog.published_count == 0
+
+        # a task that runs early tries again later
+        queued = len(self.task_stub.GetTasks('default'))
+        model.activatePost(post.key)
+        assert self.blog.published_count == 0
+        assert len(self.task_stub.GetTasks('default')) == queued + 1
+
+        post.timestamp = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        post.put()
+        model.activatePost(post.key)
+
+        assert self.blog.published_count == 1
+
+    def test_deletePost(self):
+        post = self.createPost()
+        comments = [self.createComment(post=post) for i in range(3)]
+
+        batch = model.COMMENT_BATCH
+        model.COMMENT_BATCH = 2
+        try:
+            model.deletePost(post)
+        finally:
+            model.COMMENT_BATCH = batch
+
+        assert self.blog.published_count == 0
+        assert not post.key.get()
+        assert not any(model.ndb.get_multi([comment.key for comment in comments]))
+
+    def test_publishedPosts(self):
+        post = self.createPost()
+        post.excerpt = 'test excerpt'
+        model.putPost(post)
+
+        cards = model.publishedPosts(self.author, model_class=model.BlogPostCard).fetch()
+
+        assert len(cards) == 1
+        assert cards[0].key.kind() == 'BlogPostCard'
+        assert cards[0].slug == post.slug
+        assert cards[0].excerpt == 'test excerpt'
+        assert cards[0].post_key == post.key
+
+        model.deletePost(post)
+
+        assert not model.publishedPosts(self.blog, model_class=model.BlogPostCard).fetch()
+
+    def test_nextPublish(self):
+        post = self.createPost()
+        assert self.blog.key.get().next_publish == model.NEVER
+
+        post.timestamp = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        model.putPost(post)
+        blog = self.blog.key.get()
+        assert blog.next_publish == post.timestamp
+        assert model.publishedCacheTime(blog) > 0
+
+        # the cutoff leaves it out until then
+        assert not blog.published_posts.fetch()
+
+        model.deletePost(post)
+        assert self.blog.key.get().next_publish == model.NEVER
+
+    def test_fetchPublishedPage(self):
+        post = self.createPost()
+        blog = self.blog.key.get()
+        query = blog.published_posts
+        cache_time = model.publishedCacheTime(blog)
+        assert cache_time == 0
+
+        posts, cursor, more = model.fetchPublishedPageAsync(query, 10, 'test-key', cache_time).get_result()
+        assert [p.key for p in posts] == [post.key]
+
+        # the same key finds the same posts without querying again
+        other = self.createPost(slug='other-post')
+        posts, cursor, more = model.fetchPublishedPageAsync(query, 10, 'test-key', cache_time).get_result()
+        assert [p.key for p in posts] == [post.key]
+
+        posts, cursor, more = model.fetchPublishedPageAsync(query, 10).get_result()
+        assert [p.key for p in posts] == [other.key, post.key]
+
+        # results can't be cached before the blog has a cutoff
+        blog.next_publish = None
+        assert model.publishedCacheTime(blog) is None
+
+    def test_indexPost(self):
+        post = self.createPost()
+        self.executeDeferred(name="search")
+
+        total, cards = model.searchPosts(self.blog, 'post')
+        assert total == 1
+        assert cards[0].slug == post.slug
+        assert model.searchPosts(self.blog, u'body' + UCHAR)[0] == 1
+
+        post.body = 'something else'
+        model.putPost(post)
+        self.executeDeferred(name="search")
+
+        assert model.searchPosts(self.blog, u'body' + UCHAR) == (0, [])
+        assert model.searchPosts(self.blog, 'else')[0] == 1
+
+        model.deletePost(post)
+        self.executeDeferred(name="search")
+
+        assert model.searchPosts(self.blog, 'else') == (0, [])
+        assert not model.BlogSearchShard.query(ancestor=self.blog.key).count()
+        assert not model.BlogSearchPost.query(ancestor=self.blog.key).count()
+
+    def test_reindex(self):
+        post = self.createPost()
+        self.task_stub.FlushQueue("search")
+
+        assert model.searchPosts(self.blog, 'test') == (0, [])
+
+        model.reindex(self.blog)
+
+        total, cards = model.searchPosts(self.blog, 'test post')
+        assert total == 1
+        assert cards[0].author_entity.key == post.author
+
+    def test_putLinkback(self):
+        post = self.createPost()
+        url = 'http://www.example.com/' + UCHAR
+
+        comment = model.BlogComment(url=url, pingback=True, parent=post.key)
+        assert model.putLinkback(comment)
+        assert comment.receipt_key.get()
+
+        # the same source can't link back the same way twice, but can with a different type
+        assert not model.putLinkback(model.BlogComment(url=url, pingback=True, parent=post.key))
+        assert model.putLinkback(model.BlogComment(url=url, webmention=True, parent=post.key))
+        assert post.comments.count() == 2
+
+        # once deleted it can be sent again
+        model.deleteComments([comment])
+        assert not comment.receipt_key.get()
+        assert model.putLinkback(model.BlogComment(url=url, pingback=True, parent=post.key))
+
+    def test_recount(self):
+        post = self.createPost()
+        comment = self.createComment(post=post)
+        comment.approved = True
+        comment.put()
+        model.ndb.delete_multi(model.BlogCounter.query(ancestor=self.blog.key).fetch(keys_only=True))
+
+        # without a counter the published posts are counted by a query instead
+        assert self.blog.published_count == 1
+
+        # and comments are too, then saved so the query only happens once
+        assert model.getCount(post.key, model.COMMENTS) == 1
+        assert model.BlogCounter.get_by_id(model.COMMENTS, parent=post.key).count == 1
+        assert model.BlogCounter.get_by_id(model.LINKBACKS, parent=post.key).count == 0
+        assert comment.key.get().counted
+
+        # but not while the migration that counts them is waiting to run
+        model.ndb.delete_multi(model.BlogCounter.query(ancestor=self.blog.key).fetch(keys_only=True))
+        migrations.BlogMigration(id=migrations.CommentCounts.name, parent=self.blog.key).put()
+        assert model.getCount(post.key, model.COMMENTS) == 1
+        assert not model.BlogCounter.get_by_id(model.COMMENTS, parent=post.key)
+
+        model.recount(self.blog)
+
+        assert self.blog.published_count == 1
+        assert model.getCount(post.key, model.COMMENTS) == 1
+
     def test_makeNew(self):
         # create a post so that the blog has children
         post = self.createPost()
@@ -71,6 +348,40 @@ class TestModelFunctions(BaseTestCase):
         assert new_blog.slug == 'new-blog'
 
 
+    def test_renameStep(self):
+        tag = self.createTag()
+        post = self.createPost(tags=[tag])
+        self.createComment(post=post)
+        task = renameTask
+
+        batch = model.RENAME_BATCH
+        model.RENAME_BATCH = 2
+        try:
+            model.startRename(self.blog, 'new-blog', task)
+            rename = model.renameStep('blog', 0, task)
+            assert rename.copied == 2
+            assert rename.state == model.COPYING
+
+            # running the same step again does nothing
+            assert model.renameStep('blog', 0, task) is None
+
+            step = 1
+            while not rename.finished:
+                rename = model.renameStep('blog', step, task)
+                step += 1
+        finally:
+            model.RENAME_BATCH = batch
+
+        assert not self.blog.key.get()
+        assert not model.ndb.Query(ancestor=self.blog.key).fetch(keys_only=True)
+
+        new_key = model.ndb.Key(model.Blog, 'new-blog')
+        new_post = model.BlogPost.get_by_id(post.slug, parent=new_key)
+        assert new_post.tag_keys == [model.ndb.Key(model.BlogTag, tag.slug, parent=new_key)]
+        assert new_post.comments.count() == 1
+        assert model.getCount(new_key, model.PUBLISHED_POSTS) == 1
+        assert model.renamingTo('new-blog') is None
+
     def test_slugify(self):
         name = 'Test Post with-&-a--lot---of----hyphens-' + UCHAR
         slug = model.slugify(name)
@@ -0,0 +1,39 @@
+from base import BaseTestCase, UCHAR
+
+from gae_blog import search
+
+
+class TestSearch(BaseTestCase):
+
+    def test_tokenize(self):
+        assert search.tokenize(u'The Quick, quick fox' + UCHAR + u' a 42') == [u'quick', u'quick', u'fox' + UCHAR, u'42']
+
+    def test_queryTerms(self):
+        assert search.queryTerms('fox the Fox dog') == ['fox', 'dog']
+
+        terms = ' '.join(['term' + str(i) for i in range(search.SEARCH_MAX_TERMS + 1)])
+        assert len(search.queryTerms(terms)) == search.SEARCH_MAX_TERMS
+
+    def test_shardFor(self):
+        shard = search.shardFor(u'test-post' + UCHAR)
+        assert 0 <= shard < search.SEARCH_SHARDS
+        assert search.shardFor(u'test-post' + UCHAR) == shard
+
+    def test_rank(self):
+        postings = {
+            'fox': {'one': [1, 100, 10], 'two': [5, 100, 20], 'three': [1, 100, 30], 'future': [9, 100, 50]},
+            'dog': {'one': [1, 100, 10], 'two': [1, 100, 20], 'three': [1, 100, 30]},
+            'cat': {'three': [1, 100, 30]}
+        }
+
+        # more occurrences rank higher, and ties go to the newer post
+        assert search.rank({'fox': postings['fox'], 'dog': postings['dog']}, 10, 40) == ['two', 'three', 'one']
+
+        # every term has to match
+        assert search.rank(postings, 10, 40) == ['three']
+
+        # posts in the future aren't found until they go live
+        assert search.rank({'fox': postings['fox']}, 10, 60)[0] == 'future'
+
+        assert search.rank({'fox': postings['fox'], 'bird': {}}, 10, 40) == []
+        assert search.rank({}, 10, 40) == []
@@ -0,0 +1,50 @@
+from base import BaseTestCase
+
+from gae_blog import stats
+
+
+class TestStats(BaseTestCase):
+
+    def test_percentile(self):
+        values = range(1, 101)
+
+        assert stats.percentile(values, 0.5) == 50
+        assert stats.percentile(values, 0.99) == 99
+        assert stats.percentile([3, 1, 2], 0.9) == 3
+        assert stats.percentile([5], 0.5) == 5
+        assert stats.percentile([], 0.5) is None
+
+    def test_summarize(self):
+        samples = [{"ms": 10.0, "template_ms": 2.0, "size": 100, "calls": {"datastore_v3": [2, 4.0]}},
+            {"ms": 30.0, "template_ms": 4.0, "size": None, "calls": {"datastore_v3": [4, 8.0], "memcache": [1, 1.0]}}]
+
+        summary = stats.summarize(samples)
+
+        assert summary["count"] == 2
+        assert summary["p50"] == 10.0
+        assert summary["p90"] == 30.0
+        assert summary["template_ms"] == 3.0
+        assert summary["size"] == 100
+        assert summary["calls"] == {"datastore_v3": (3.0, 6.0), "memcache": (0.5, 0.5)}
+
+    def test_recorder(self):
+        recorder = stats.Recorder('/blog')
+        stats.current.recorder = recorder
+        stats.installHooks()
+        try:
+            stats.setController('TestController')
+            self.createBlog()
+            stats.addTemplateTime(0.002)
+        finally:
+            stats.current.recorder = None
+
+        sample = recorder.sample(200, 10)
+        assert sample["controller"] == 'TestController'
+        assert sample["calls"]["datastore_v3"][0] >= 1
+        assert sample["template_ms"] == 2.0
+
+        # the samples kept are limited to the most recent ones
+        for i in range(stats.STATS_SAMPLES + 1):
+            stats.saveSample(sample)
+
+        assert len(stats.getSamples(['TestController'])['TestController']) == stats.STATS_SAMPLES
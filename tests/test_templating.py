@@ -0,0 +1,44 @@
+import shutil
+import tempfile
+
+from base import BaseTestCase
+
+from gae_blog import templating
+
+
+class TestTemplating(BaseTestCase):
+
+    def test_join_path(self):
+        environment = templating.makeEnvironment(development=True)
+
+        assert environment.join_path('../base.html', 'admin/index.html') == 'base.html'
+        assert environment.join_path('base.html', 'admin/index.html') == 'admin/base.html'
+        assert environment.join_path('../../custom.html', 'base.html') == '../../custom.html'
+
+    def test_list_templates(self):
+        names = templating.RelativeLoader().list_templates()
+
+        assert 'index.html' in names
+        assert 'admin/index.html' in names
+
+    def test_makeEnvironment(self):
+        path = templating.COMPILED_TEMPLATES_PATH
+        templating.COMPILED_TEMPLATES_PATH = tempfile.mkdtemp()
+        try:
+            # nothing compiled yet
+            shutil.rmtree(templating.COMPILED_TEMPLATES_PATH)
+            environment = templating.makeEnvironment(development=False)
+            assert isinstance(environment.loader, templating.RelativeLoader)
+            assert not environment.auto_reload
+
+            templating.makeEnvironment(development=True).compile_templates(templating.COMPILED_TEMPLATES_PATH, zip=None)
+            environment = templating.makeEnvironment(development=False)
+            assert not environment.auto_reload
+
+            # compiled templates are loaded without their source, and anything else still is
+            compiled, source = environment.loader.loaders
+            assert compiled.load(environment, 'admin/index.html').name == 'admin/index.html'
+            assert environment.get_template('../templates/index.html')
+        finally:
+            shutil.rmtree(templating.COMPILED_TEMPLATES_PATH, ignore_errors=True)
+            templating.COMPILED_TEMPLATES_PATH = path
@@ -0,0 +1,47 @@
+from google.appengine.api import memcache
+
+from base import BaseTestCase
+
+from gae_blog import throttle
+
+
+class TestThrottle(BaseTestCase):
+
+    def setUp(self):
+        super(TestThrottle, self).setUp()
+
+        self.now = 1000.0
+        self.real_time = throttle.time.time
+        throttle.time.time = lambda: self.now
+
+    def tearDown(self):
+        throttle.time.time = self.real_time
+
+        super(TestThrottle, self).tearDown()
+
+    def test_consume(self):
+        assert throttle.consume('blog|ip', 2, period=60)
+        assert throttle.consume('blog|ip', 2, period=60)
+        assert not throttle.consume('blog|ip', 2, period=60)
+
+        # other buckets are separate
+        assert throttle.consume('blog|other', 2, period=60)
+
+        # a token comes back after its share of the period
+        self.now += 30
+        assert throttle.consume('blog|ip', 2, period=60)
+        assert not throttle.consume('blog|ip', 2, period=60)
+
+        # a lost bucket starts over full rather than refusing anyone
+        memcache.flush_all()
+        assert throttle.consume('blog|ip', 2, period=60)
+
+    def test_firedCounts(self):
+        assert throttle.firedCounts('blog') == {throttle.IP: 0, throttle.BLOG: 0}
+
+        throttle.fired('blog', throttle.IP)
+        throttle.fired('blog', throttle.IP)
+        throttle.fired('blog', throttle.BLOG)
+
+        assert throttle.firedCounts('blog') == {throttle.IP: 2, throttle.BLOG: 1}
+        assert throttle.firedCounts('other') == {throttle.IP: 0, throttle.BLOG: 0}
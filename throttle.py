@@ -0,0 +1,53 @@
+# token buckets in memcache for limiting how often anything can be written through the public pages
+
+import logging
+import time
+
+from google.appengine.api import memcache
+
+from gae_blog.config import THROTTLE_PERIOD, THROTTLE_RETRIES
+
+BUCKET_KEY = "GAE_BLOG_BUCKET"
+FIRED_KEY = "GAE_BLOG_THROTTLED"
+
+# the limits that can fire
+IP = "ip"
+BLOG = "blog"
+
+
+def consume(key, budget, period=THROTTLE_PERIOD):
+    """ takes a token from a bucket holding up to `budget` that refills evenly over `period` seconds
+        returns False if it's empty, and True whenever memcache can't tell so that nobody is wrongly refused """
+    client = memcache.Client()
+    key = BUCKET_KEY + "|" + key
+    rate = float(budget) / period
+    for i in range(THROTTLE_RETRIES):
+        now = time.time()
+        bucket = client.gets(key)
+        if bucket is None:
+            # a cold or evicted bucket starts out full
+            if client.add(key, (budget - 1, now), time=period):
+                return True
+            continue
+
+        tokens, updated = bucket
+        tokens = min(budget, tokens + (now - updated) * rate)
+        if tokens < 1:
+            return False
+        if client.cas(key, (tokens - 1, now), time=period):
+            return True
+
+    # memcache is down or too busy to say
+    return True
+
+
+def fired(slug, limit):
+    """ counts each time a limit refuses a request """
+    logging.warning("the %s write limit was reached for blog %s", limit, slug)
+    memcache.incr("|".join([FIRED_KEY, slug, limit]), initial_value=0)
+
+
+def firedCounts(slug):
+    """ how often each limit has refused a request, for as long as memcache has kept count """
+    counts = memcache.get_multi([IP, BLOG], key_prefix="|".join([FIRED_KEY, slug, ""]))
+    return dict([(limit, counts.get(limit, 0)) for limit in [IP, BLOG]])